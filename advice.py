@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+import math
+import copy
+import os
+import queue
+import threading
+import hex
+import solver
+import tkinter
+
+# the tile lays open to a company, richest first, by what it would
+# earn after each (see MapSolver.adviseTiles). clicking one lays it.
+# the lays are tried on a background thread, like MapWindow.solve, and
+# spread over a process pool.
+class AdviceWindow:
+    TITLE = "Tile lays"
+    MAX_OPTIONS = 20
+    OPTIONS_PER_ROW = 5
+
+    def __init__(self, mapWindow, ci):
+        self.mapWindow = mapWindow
+        self.map = self.mapWindow.map
+        self.company = self.map.companies[ci]
+        self.root = None
+        self.HEXSIZE = 40
+
+    def go(self):
+        self.root = tkinter.Toplevel(self.mapWindow.root)
+        self.root.wm_title("%s for: %s" % (self.TITLE, self.company.name))
+        self.root.protocol("WM_DELETE_WINDOW", lambda: self.close())
+        self.root.bind("<Key>", lambda event: self.close() if event.char == 'q' else None)
+
+        self.frame = tkinter.Frame(self.root)
+        self.frame.pack(fill="both", expand=True)
+
+        self.statusText = tkinter.StringVar()
+        self.statusText.set("Trying %s..." % self.TITLE.lower())
+        tkinter.Label(self.frame, textvariable=self.statusText,
+                      font=("", 16, "bold")).grid(row=0, column=0, columnspan=100)
+
+        # advise on a snapshot, since the map and trains may be edited
+        # while the options are tried. updatePhase changes the state
+        # in place, and updateTrains each company, so the snapshot
+        # gets copies of its own
+        self.state = self.map.state
+        snapshot = copy.copy(self.map)
+        snapshot.state = copy.copy(self.map.state)
+        snapshot.companies = [ copy.copy(c) for c in self.map.companies ]
+        company = copy.copy(self.company)
+        company.trains = list(company.trains)
+
+        s = solver.MapSolver(snapshot)
+        s.trace = None
+        results = queue.Queue()
+        threading.Thread(target=lambda: self.run(s, company, results), daemon=True).start()
+        self.poll(results)
+
+    # runs on the background thread. whatever happens, something goes
+    # on results, or poll would wait for it forever
+    def run(self, s, company, results):
+        try:
+            results.put(self.advise(s, company))
+        except Exception as e:
+            results.put(e)
+
+    def advise(self, s, company):
+        return s.adviseTiles(company, workers=os.cpu_count() or 1)
+
+    def poll(self, results):
+        # closed before the options were tried
+        if self.root == None: return
+
+        if results.empty():
+            self.root.after(100, lambda: self.poll(results))
+            return
+
+        result = results.get()
+        if isinstance(result, Exception):
+            self.statusText.set("Couldn't try %s: %s" % (self.TITLE.lower(), result))
+        else:
+            self.show(*result)
+
+    def show(self, revenue, options):
+        self.statusText.set("Revenue now: %d; %d tile lays" % (revenue, len(options)))
+
+        for i, (tileRevenue, r, c, hx) in enumerate(options[:self.MAX_OPTIONS]):
+            w = 2*math.sin(math.pi/3)*self.HEXSIZE + self.mapWindow.PADDING
+            h = 2*self.HEXSIZE + self.mapWindow.PADDING * 2
+            canvas = tkinter.Canvas(self.frame,
+                                    width=w,
+                                    height=h,
+                                    background="#888888")
+            canvas.grid(row=1 + int(i / self.OPTIONS_PER_ROW), column=i % self.OPTIONS_PER_ROW)
+            canvas.bind("<Button-1>", lambda event, r=r, c=c, hx=hx: self.updateHex(r, c, hx))
+
+            hw = hex.HexWindow(hx, 0, 0, self.HEXSIZE)
+            hw.draw(canvas)
+
+            canvas.create_text(4, 4, text="(%d, %d)" % (r, c),
+                               fill='white', anchor=tkinter.NW)
+            canvas.create_text(w/2, h - 4, text="%d (%+d)" % (tileRevenue, tileRevenue - revenue),
+                               fill='white', anchor=tkinter.S)
+
+    def updateHex(self, r, c, choice):
+        if self.map.state is not self.state:
+            self.statusText.set("The map has changed since; ask again")
+            return
+        self.map.updateHex(r, c, choice)
+        self.close()
+
+    def close(self):
+        self.root.destroy()
+        self.root = None
+        self.mapWindow.redraw()
+        self.mapWindow.adviceWindow = None
+
+# the stations open to a company, richest first, with what each would
+# cost the other companies (see MapSolver.adviseStations). clicking one
+# places it.
+class StationAdviceWindow(AdviceWindow):
+    TITLE = "Stations"
+
+    def advise(self, s, company):
+        return s.adviseStations(company, workers=os.cpu_count() or 1)
+
+    def show(self, revenue, options):
+        self.statusText.set("Revenue now: %d; %d stations" % (revenue, len(options)))
+
+        for i, (stationRevenue, r, c, ci, losses) in enumerate(options[:self.MAX_OPTIONS]):
+            costs = ", ".join([ "%s %d" % (self.map.companies[oi].name, loss)
+                                for oi, loss in sorted(losses.items()) ])
+            text = "(%d, %d) c%d: %d (%+d)%s" % (r, c, ci, stationRevenue, stationRevenue - revenue,
+                                                 "; costs " + costs if costs else "")
+            label = tkinter.Label(self.frame, text=text, anchor=tkinter.W)
+            label.grid(row=1 + i, column=0, sticky=tkinter.W)
+            label.bind("<Button-1>", lambda event, r=r, c=c, ci=ci: self.updateCity(r, c, ci))
+
+    def updateCity(self, r, c, ci):
+        if self.map.state is not self.state:
+            self.statusText.set("The map has changed since; ask again")
+            return
+        city = self.map.getHex(r, c).cities[ci]
+        self.map.updateCity(r, c, ci, city.index(None), self.company.id)
+        self.close()
@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+# benchmarks for the route solver. usage:
+#
+#   benchmark.py corpus
+#       (re)builds the saved games in corpus/ by playing random tile
+#       lays and stations on 1817.map and 1822.map
+#
+#   benchmark.py run out.json [engine ...]
+#       solves every corpus game and synthetic board with each engine
+#       (default: bnb and milp; stream is much slower on the bigger
+#       boards, so it is only run when asked for), REPEATS times each,
+#       and records the results of the fastest solve
+#
+#   benchmark.py compare baseline.json out.json
+#       flags any case that got a different revenue, or took more
+#       search steps or tried more combinations than the baseline by
+#       more than TOLERANCE, and exits with status 1 if anything was
+#       flagged. those counts are the same from run to run; wall
+#       times aren't, so a case that got slower by as much is only
+#       noted.
+#
+# the saved games are pickled Maps, same as the 'x' key in MapWindow
+# saves, so any of them can also be opened with 1817.py or 1822.py.
+# corpus/baseline.json is a run of all three engines; its times are
+# from one machine, so make a fresh baseline before comparing times on
+# another.
+
+import contextlib
+import copy
+import io
+import json
+import os
+import pickle
+import random
+import sys
+import time
+
+import map
+import solver
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+# (name, map file, seed, tile lays tried, phase, stations per company,
+# trains for each company)
+GAMES = [ ("1817-mid", "1817.map", 1, 300, 1, 2, [4, 3, 3]),
+          ("1817-late", "1817.map", 2, 800, 2, 3, [6, 4, 3, 2]),
+          ("1822-mid", "1822.map", 3, 400, 1, 2, ["E", 3, "L"]),
+          ("1822-late", "1822.map", 4, 1500, 3, 3, [7, 5, 4]) ]
+
+# (name, seed, rows, columns, track density, stations per company,
+# trains for each company). see syntheticBoard.
+BOARDS = [ ("small-sparse", 1, 6, 8, 2, 2, [3, 2]),
+           ("medium", 2, 9, 12, 2.5, 2, [4, 3, 2]),
+           ("large-dense", 3, 12, 16, 3, 3, [5, 4, 3]) ]
+
+# how many companies of each game or board to solve for
+COMPANIES = 4
+
+# how many times each case is solved; the fastest counts
+REPEATS = 3
+
+# how many more search steps or combinations count as a regression
+# (and how much slower is worth noting), and the least wall time
+# difference worth noting
+TOLERANCE = 1.25
+SLACK = 0.05
+
+def quietly(f, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f(*args, **kwargs)
+
+# lays up to lays random tiles, then places stations for the first
+# COMPANIES companies and hands them trains
+def playRandomly(m, seed, lays, phase, stations, trains):
+    rng = random.Random(seed)
+
+    for i in range(lays):
+        r, c, hx = rng.choice(m.getHexes())
+        upgrades = hx.getUpgrades(r, c, m)
+        if len(upgrades) == 0: continue
+        quietly(m.updateHex, r, c, rng.choice(rng.choice(upgrades)))
+
+    m.state.phase = phase
+
+    cities = [ (r, c, ci) for r, c, hx in m.getHexes() for ci in range(len(hx.cities)) ]
+    for company in m.companies[:COMPANIES]:
+        for i in range(stations):
+            r, c, ci = rng.choice(cities)
+            city = m.getHex(r, c).cities[ci]
+            if None in city:
+                quietly(m.updateCity, r, c, ci, city.index(None), company.id)
+        company.trains = list(trains)
+
+    # the saved game doesn't need to be undone
+    m.history = [ m.state ]
+    m.undoLog = [ m.state ]
+    return m
+
+def buildCorpus():
+    os.makedirs(CORPUS, exist_ok=True)
+    for name, mapFile, seed, lays, phase, stations, trains in GAMES:
+        m = map.Map()
+        m.load(os.path.join(os.path.dirname(CORPUS), mapFile))
+        playRandomly(m, seed, lays, phase, stations, trains)
+
+        with open(os.path.join(CORPUS, name + ".save"), "wb") as f:
+            pickle.dump(m, f)
+        print ("Saved %s" % name)
+
+# a made-up board of rows x columns hexes, using 1817's tiles,
+# companies and trains. about one hex in five is a city, with Chicago
+# or St. Louis on the west edge of every third row and Montreal or the
+# Maritimes along the north edge. density is how many tile lays are
+# tried per hex.
+def syntheticBoard(seed, rows, columns, density, stations, trains):
+    rng = random.Random(seed)
+
+    with open(os.path.join(os.path.dirname(CORPUS), "1817.map"), "r") as f:
+        obj = json.load(f)
+
+    # bigger boards would run out of 1817's tiles
+    for tile in obj["Tiles"].values():
+        tile.pop("num", None)
+
+    # like the real maps, an empty first row and column keep track
+    # from wrapping around to the far edges
+    board = [ [ "" ] * (columns + 1) ]
+    for r in range(rows):
+        row = [ "" ] + [ "City %d-%d" % (r, c) if rng.random() < 0.2 else "E" for c in range(columns) ]
+        if r % 3 == 1 and r + 1 < rows:
+            row[1] = rng.choice([ "Chicago", "St. Louis" ])
+        board.append(row)
+    for c in range(2, columns, 4):
+        board[1][c] = rng.choice([ "Montreal", "Maritime Prov." ])
+    obj["Map"] = board
+
+    m = map.Map()
+    m.loadObject(obj)
+    return playRandomly(m, seed, int(density * rows * columns), 2, stations, trains)
+
+def cases():
+    for name, mapFile, seed, lays, phase, stations, trains in GAMES:
+        with open(os.path.join(CORPUS, name + ".save"), "rb") as f:
+            yield name, pickle.load(f)
+
+    for name, seed, rows, columns, density, stations, trains in BOARDS:
+        yield name, quietly(syntheticBoard, seed, rows, columns, density, stations, trains)
+
+def run(engines):
+    results = []
+    for name, m in cases():
+        for ci, company in enumerate(m.companies[:COMPANIES]):
+            for engine in engines:
+                wall = None
+                for i in range(REPEATS):
+                    # each solve gets a fresh copy, with nothing cached
+                    s = solver.MapSolver(copy.deepcopy(m))
+                    s.trace = None
+                    start = time.time()
+                    revenues, routes = s.solve(company, engine=engine)
+                    elapsed = time.time() - start
+                    if wall == None or elapsed < wall:
+                        wall = elapsed
+                        stats = s.stats
+
+                # the streaming engine finds routes as it searches
+                routeSeconds = stats.timings["routes" if engine != "stream" else "search"]
+                results.append({ "case": "%s/%s" % (name, ci),
+                                 "engine": engine,
+                                 "trains": [ str(t) for t in company.trains ],
+                                 "revenue": revenues,
+                                 "routes": stats.routes,
+                                 "peakRoutes": stats.peakRoutes,
+                                 "routesPerSecond": stats.routes / routeSeconds if routeSeconds > 0 else None,
+                                 "explorations": stats.explorations,
+                                 "combinations": stats.combinations,
+                                 "prunes": stats.prunes,
+                                 "timings": stats.timings,
+                                 "provenOptimal": stats.provenOptimal,
+                                 "wall": wall })
+                print ("%-20s %-6s revenue %5s, %6s routes, %8s combinations, %7.3f seconds" %
+                       (results[-1]["case"], engine, revenues, stats.routes, stats.combinations, wall))
+                sys.stdout.flush()
+    return results
+
+def compare(baseline, current):
+    baseline = dict([ ((r["case"], r["engine"]), r) for r in baseline ])
+
+    flagged = 0
+    slower = 0
+    for r in current:
+        key = (r["case"], r["engine"])
+        if key not in baseline:
+            print ("%-20s %-6s new case" % key)
+            continue
+        b = baseline[key]
+
+        problems = []
+        if r["revenue"] != b["revenue"] and r["provenOptimal"] and b["provenOptimal"]:
+            problems.append("revenue %s, was %s" % (r["revenue"], b["revenue"]))
+        if r["explorations"] > b["explorations"] * TOLERANCE:
+            problems.append("%s search steps, was %s" % (r["explorations"], b["explorations"]))
+        if r["combinations"] > b["combinations"] * TOLERANCE:
+            problems.append("%s combinations, was %s" % (r["combinations"], b["combinations"]))
+
+        timing = "%.3f seconds, was %.3f" % (r["wall"], b["wall"])
+        if r["wall"] > b["wall"] * TOLERANCE and r["wall"] - b["wall"] > SLACK:
+            slower += 1
+            timing = "slower: " + timing
+
+        if len(problems) > 0:
+            flagged += 1
+            print ("%-20s %-6s REGRESSED: %s (%s)" % (key + ("; ".join(problems), timing)))
+        else:
+            print ("%-20s %-6s ok (%s)" % (key + (timing,)))
+
+    print ("%s of %s cases regressed; %s slower" % (flagged, len(current), slower))
+    return flagged == 0
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "corpus":
+        buildCorpus()
+    elif len(sys.argv) >= 3 and sys.argv[1] == "run":
+        results = run(sys.argv[3:] or [ "bnb", "milp" ])
+        with open(sys.argv[2], "w") as f:
+            json.dump(results, f, indent=1)
+    elif len(sys.argv) == 4 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        with open(sys.argv[3]) as f:
+            current = json.load(f)
+        sys.exit(0 if compare(baseline, current) else 1)
+    else:
+        print ("usage: %s corpus | run out.json [engine ...] | compare baseline.json out.json" % sys.argv[0])
+        sys.exit(2)
@@ -5,10 +5,13 @@ import json
 import hex
 import copy
 import upgrade
+import advice
 import solver, company
 import pickle
 import numpy as np
 import time
+import threading
+import queue
 from misc import *
 
 class Map:
@@ -33,7 +36,10 @@ class Map:
     def load(self, filename):
         with open(filename, 'r') as f:
             obj = json.load(f)
+        self.loadObject(obj)
 
+    # obj is the contents of a .map file
+    def loadObject(self, obj):
         map = obj["Map"]
         if "Transposed" in obj.keys() and obj["Transposed"] == "True":
             newMap = []
@@ -201,12 +207,8 @@ class Map:
         # map state is immutable. always copy before modifying
         self.state = copy.deepcopy(self.state)
 
-        # check if the hex is an upgrade and we should track what it
-        # downgraded to
-        newHex = copy.deepcopy(choice)
         oldHex = self.getHex(row, col)
-        if oldHex.isUpgrade(newHex):
-            newHex.downgradesTo = oldHex
+        newHex = self.placeHex(row, col, choice)
 
         # decrement new tile type and increment the old
         if newHex.key in self.state.tileLimits.keys(): self.state.tileLimits[newHex.key] -= 1
@@ -214,9 +216,20 @@ class Map:
 
         # finally, update the hex and log the new game state
         self.state.hexes[row][col] = newHex
-        if newHex != None:
-            newHex.row = row
-            newHex.col = col
+        self.log()
+
+    # the hex left at (row, col) by laying choice there: a copy of
+    # choice, holding the stations of the hex it replaces
+    def placeHex(self, row, col, choice):
+        # check if the hex is an upgrade and we should track what it
+        # downgraded to
+        newHex = copy.deepcopy(choice)
+        oldHex = self.getHex(row, col)
+        if oldHex.isUpgrade(newHex):
+            newHex.downgradesTo = oldHex
+
+        newHex.row = row
+        newHex.col = col
 
         # copy tokens
         if newHex.type != "base" and (oldHex.type == "base" or newHex.type > oldHex.type):
@@ -228,8 +241,36 @@ class Map:
                     nci = cityMap[ci]
                     newHex.cities[nci][cityIndex[nci]] = j
                     cityIndex[nci] += 1
-            
-        self.log()
+
+        return newHex
+
+    # a copy of the map as it would be after a change, for trying
+    # moves out. unlike the update methods, this doesn't copy the whole
+    # state or log anything: the copy shares every hex with this map,
+    # so the caller replaces (never modifies) the hexes it changes.
+    def overlay(self):
+        m = copy.copy(self)
+        m.state = copy.copy(self.state)
+        m.state.hexes = [ list(row) for row in self.state.hexes ]
+        m.history = [ m.state ]
+        m.undoLog = [ m.state ]
+        m.undoPosition = -1
+        m.historyPosition = -1
+        return m
+
+    # the map with choice laid at (row, col), as an overlay
+    def withHex(self, row, col, choice):
+        m = self.overlay()
+        m.state.hexes[row][col] = self.placeHex(row, col, choice)
+        return m
+
+    # the map with company's station in a city, as an overlay
+    def withStation(self, row, col, city, station, company):
+        m = self.overlay()
+        hx = copy.deepcopy(self.getHex(row, col))
+        hx.cities[city][station] = company
+        m.state.hexes[row][col] = hx
+        return m
 
     def updateCity(self, row, col, city, station, company):
         # map state is immutable. always copy before modifying
@@ -261,6 +302,12 @@ class MapWindow:
     def __init__(self, map, hexsize=50):
         self.map = map
         self.upgradeWindow = None
+        self.adviceWindow = None
+        self.routeCache = solver.RouteCache()
+        self.routeIndex = solver.RouteIndex()
+        self.solver = None
+        self.solveThread = None
+        self.solveStatus = ""
 
     def run(self):        
         self.init()
@@ -282,16 +329,87 @@ class MapWindow:
         if event.char == '+' or event.char == '=':
             self.zoom(1.25, self.root.winfo_width() / 2, self.root.winfo_height() / 2)
 
+    # solves run on a background thread so the window stays live. the
+    # thread only talks to the window through a queue of improved
+    # solutions, which pollSolve drains from the Tk event loop.
     def solve(self, ci):
-        s = solver.MapSolver(self.map)
+        # a new solve replaces whatever is still running
+        self.cancelSolve()
+
+        # solve a snapshot, since the map and trains may be edited
+        # while the search runs. tile lays and stations replace the
+        # state, but updatePhase changes it in place, so it gets a
+        # copy of its own
+        snapshot = copy.copy(self.map)
+        snapshot.state = copy.copy(self.map.state)
+        company = copy.copy(self.map.companies[ci])
+        company.trains = list(company.trains)
+
+        s = solver.MapSolver(snapshot, self.routeCache, self.routeIndex)
         solId = time.time()
-        self.map.solution = list(s.solve(self.map.companies[ci])) + [solId]
-        self.redraw()
-        self.root.after(10000, lambda solId=solId: self.clearSolution(solId))
+        updates = queue.Queue()
+        previous = self.solveThread
+
+        def run():
+            # solves share the route cache and index, so wait for the one that
+            # was just cancelled to wind down
+            if previous != None:
+                previous.join()
+            updates.put(s.solve(company, onImprove=lambda revenues, routes: updates.put((revenues, routes))))
+
+        self.solver = s
+        self.solveThread = threading.Thread(target=run, daemon=True)
+        self.solveThread.start()
+        self.pollSolve(s, solId, updates)
+
+    # right-clicking a company lists the tile lays that would earn it
+    # the most, or with shift, the stations
+    def advise(self, ci, stations=False):
+        if self.adviceWindow != None:
+            self.adviceWindow.close()
+        if stations:
+            self.adviceWindow = advice.StationAdviceWindow(self, ci)
+        else:
+            self.adviceWindow = advice.AdviceWindow(self, ci)
+        self.adviceWindow.go()
+
+    def pollSolve(self, s, solId, updates):
+        # superseded by a newer solve
+        if self.solver is not s: return
+
+        # check before draining, so nothing put by the thread on its
+        # way out is missed
+        done = not self.solveThread.is_alive()
+
+        improved = False
+        while not updates.empty():
+            revenues, routes = updates.get()
+            self.map.solution = [ revenues, routes, solId ]
+            improved = True
+
+        if done:
+            self.solver = None
+            self.solveStatus = "" if s.provenOptimal else "(stopped)"
+            self.root.after(10000, lambda solId=solId: self.clearSolution(solId))
+        else:
+            self.solveStatus = s.progress()
+
+        if improved:
+            self.redraw()
+        else:
+            self.updateSolutionLabel()
+
+        if not done:
+            self.root.after(100, lambda: self.pollSolve(s, solId, updates))
+
+    def cancelSolve(self):
+        if self.solver != None:
+            self.solver.cancel()
 
     def clearSolution(self, solId):
         if self.map.solution != None and self.map.solution[-1] == solId:
             self.map.solution = None
+            self.solveStatus = ""
             self.redraw()
 
     def undo(self):
@@ -373,6 +491,7 @@ class MapWindow:
         self.root.wm_title("18xx")
         self.root.bind("<Key>", lambda event: self.key(event))
         # self.root.bind("<Escape>", lambda event: exit(0))
+        self.root.bind("<Escape>", lambda event: self.cancelSolve())
         self.root.bind("<Left>", lambda event: self.undo())
         self.root.bind("<Right>", lambda event: self.redo())
         self.root.bind("<Down>", lambda event: self.backward())
@@ -418,6 +537,8 @@ class MapWindow:
             hex.HexWindow.drawStation(canvas,np.array([SIZE/2,SIZE/2]),SIZE/2,company)
             canvas.pack(side=tkinter.LEFT) # grid(row=1, column=2*ci)
             canvas.bind("<Button-1>", lambda event, ci=ci: self.solve(ci))
+            canvas.bind("<Button-3>", lambda event, ci=ci: self.advise(ci))
+            canvas.bind("<Shift-Button-3>", lambda event, ci=ci: self.advise(ci, stations=True))
 
             content = tkinter.StringVar()
             content.set(','.join([str(t) for t in company.trains]))
@@ -466,10 +587,13 @@ class MapWindow:
         self.turnLabelText.set("Turn %d" % (len(self.map.undoLog) + self.map.undoPosition + 1))
         self.turnLabel.config(font=("",16,"bold"), fg="gray")
 
+        self.updateSolutionLabel()
+
+    def updateSolutionLabel(self):
         if self.map.solution:
-            self.solutionLabelText.set("Revenue: %d" % (self.map.solution[0]))
+            self.solutionLabelText.set("Revenue: %d %s" % (self.map.solution[0], self.solveStatus))
         else:
-            self.solutionLabelText.set("")
+            self.solutionLabelText.set(self.solveStatus)
         self.solutionLabel.config(fg="red", font=("",16,"bold"))
 
     def moveFrom(self, event):
@@ -507,6 +631,8 @@ class MapWindow:
     def click(self, event):
         delta = np.array((event.x, event.y)) - self.dragStart
         if np.sum(delta**2) > self.HEXSIZE / 2: return
+
+        self.cancelSolve()
         
         r, c = self.pixelToHex(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
 
@@ -5,22 +5,84 @@
 #
 # a full-fledged ILP solver like CPLEX would probably be better, if I
 # could figure out how to express the problem as integer constraints.
+#
+# (the "milp" engine does exactly that: picking routes is a
+# set-packing problem over the enumerated routes, which scipy's HiGHS
+# interface solves directly. see findBestRoutesMILP.)
 
 import copy
 import company
 import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import math
+import multiprocessing
+import multiprocessing.shared_memory
 import sortedcontainers
 import time
 import hex
+import train
+import numpy as np
+import scipy.optimize
+import scipy.sparse
 
 class MapSolver:
-    def __init__(self, map):
+    def __init__(self, map, routeCache=None, routeIndex=None):
         self.map = map
+        self.routeCache = routeCache
+        self.routeIndex = routeIndex
         self.recursionDepth = 0
         self.explorations = 0
+        self.numRoutes = 0
         self.combinations = 0
+        # when the search of the routes found began (see progress)
+        self.searchStart = None
+        self.memoSize = 100000
+        self.memoHits = 0
+        self.memoMisses = 0
+        # the root of the search, and any level with at least this many
+        # trains left to place, gets an LP bound (see lpRelaxation);
+        # None turns it off
+        self.lpTrains = 4
+
+        # trace, if set, is called as trace(event, *args) as the solve
+        # goes (see printTrace for the events). the default prints
+        # them; None turns it off. enableLog also sends an event for
+        # every step of the route search, which is slow.
+        self.trace = MapSolver.printTrace
         self.enableLog = False
 
+        # what the last solve did (see Stats)
+        self.stats = MapSolver.Stats()
+
+        # a train with at least this many routes left to try at some
+        # level of the search has the ones that conflict with the
+        # routes already placed filtered out in bulk (see
+        # branchAndBound); None turns it off
+        self.vectorRoutes = 16
+
+        # the RouteTable that the combination search's route indices
+        # refer to
+        self.routeTable = None
+
+        # how far to take the search for trains with no distance limit
+        # (see findUnlimitedRoutes)
+        self.unlimitedExplorations = 1000000
+
+        # search budget (see solve)
+        self.onImprove = None
+        self.deadline = None
+        self.nodeLimit = None
+        self.provenOptimal = True
+        self.stopped = False
+        self.cancelled = False
+
+        # the solver findBoardRoutes is searching with, if any (see
+        # cancel)
+        self.boardSolver = None
+
     def findStartingCities(self, company):
         self.startingCities = []
         
@@ -28,7 +90,7 @@ class MapSolver:
             for ci, city in enumerate(hx.cities):
                 if company.id in city:
                     self.startingCities.append( (r,c,"c%d" % ci) )
-        print ("Starting cities for company %s: %s" % (company.id, self.startingCities))
+        self.traceEvent("startingCities", company.id, self.startingCities)
 
         self.startingCitiesSet = set(self.startingCities)
 
@@ -38,10 +100,21 @@ class MapSolver:
         def __init__(self):
             self.vertices = {}
             self.edges = {}
+            # contracted edges (see contractGraph)
+            self.links = {}
+            self.reach = {}
+            # how far each place is from the company's stations (see
+            # findTokenDistances)
+            self.tokenDistance = None
+            # board size, for numbering locations (see RouteTable)
+            self.width = None
+            self.words = None
 
     class Vertex:
-        def __init__(self, loc, revenue, distance, stop, blocked):
+        def __init__(self, loc, id, revenue, distance, stop, blocked):
             self.loc = loc
+            # RouteTable.hexsideBit for hexsides, nodeId otherwise
+            self.id = id
             self.revenue = revenue
             self.distance = distance
             self.stop = stop
@@ -50,44 +123,182 @@ class MapSolver:
         def __repr__(self):
             return "rev: %s, dist: %s, stop: %s" % (self.revenue, self.distance, self.stop)
 
-    def buildGraph(self, company):
+    # what a solve did, kept in solver.stats (for solveAll, each
+    # company's stats go out with its "solved" trace event).
+    #
+    # prunes counts why candidate routes were passed over: "bound" is
+    # each time a train's list was cut off because nothing further
+    # down could pay enough, "conflict" and "filtered" are routes
+    # skipped for sharing track one at a time and in bulk (see
+    # branchAndBound), "lp" are routes cut off by the LP bound, and
+    # "dominated" are routes dropped before the search even started.
+    #
+    # timings are the seconds spent building graphs ("graph"),
+    # finding routes ("routes") and picking them ("search"). routes
+    # the stream engine finds as it searches count towards the search.
+    class Stats:
+        def __init__(self, engine=None, company=None):
+            self.engine = engine
+            self.company = company
+            self.trains = []
+            self.revenue = 0
+            self.provenOptimal = True
+
+            self.explorations = 0
+            self.routes = 0
+            self.peakRoutes = 0
+            self.combinations = 0
+            self.naiveCombinations = 0
+            self.reducedCombinations = 0
+            self.memoHits = 0
+            self.memoMisses = 0
+            self.milpVariables = 0
+            self.milpConstraints = 0
+
+            self.prunes = dict([ (reason, 0) for reason in [ "bound", "conflict", "filtered", "lp", "dominated" ] ])
+            self.timings = dict([ (phase, 0.) for phase in [ "graph", "routes", "search" ] ])
+
+        def elapsed(self):
+            return sum(self.timings.values())
+
+        def summary(self):
+            if self.engine == "milp":
+                text = ("Solved MILP with %s variables and %s hexside constraints in %4g seconds" %
+                        (self.milpVariables, self.milpConstraints, self.timings["search"]))
+            elif self.engine == "stream":
+                text = ("Generated %s routes in %s steps, tried %s combinations, %s memo hits, %s misses, in %4g seconds" %
+                        (self.routes, self.explorations, self.combinations, self.memoHits, self.memoMisses,
+                         self.elapsed()))
+            else:
+                text = ("Tried %s combinations (%.2g%% of %s, or %s without reordering identical trains), "
+                        "%s memo hits, %s misses, %s LP cutoffs, in %4g seconds" %
+                        (self.combinations, 100. * self.combinations / max(1, self.naiveCombinations),
+                         self.naiveCombinations, self.reducedCombinations, self.memoHits, self.memoMisses,
+                         self.prunes["lp"], self.timings["search"]))
+            return "(%s%s)" % (text, "" if self.provenOptimal else ", stopped early")
+
+    # the default trace: prints each event as it comes. the events and
+    # their arguments are:
+    #
+    #   solve (company), solveAll (number of companies)
+    #   startingCities (company id, cities)
+    #   routes (RouteTable, steps taken, seconds): after each search
+    #   reusedRoutes (cities reused, cities): from the route cache
+    #   unlimitedStopped (routes, steps): see findUnlimitedRoutes
+    #   dominated (train, routes dropped, routes): see pruneDominatedRoutes
+    #   improved (revenues, route indices): a better answer was found
+    #   solved (Stats, route table, route indices): the answer
+    #   adviseTiles (company)
+    #   tile (row, col, hex, revenue): see adviseTiles
+    #   adviseStations (company)
+    #   station (row, col, city, revenue, losses): see adviseStations
+    #   log (depth, *args): with enableLog, each step of the searches
+    @staticmethod
+    def printTrace(event, *args):
+        if event == "solve":
+            print ("Optimizing routes for:", *args)
+        elif event == "solveAll":
+            print ("Optimizing routes for %s companies" % args)
+        elif event == "startingCities":
+            print ("Starting cities for company %s: %s" % args)
+        elif event == "routes":
+            routes, steps, elapsed = args
+            print ("Found %s routes in %s steps and %4g seconds:" % (len(routes), steps, elapsed))
+            for ri in range(min(len(routes), 25)):
+                print ("    " + routes.describe(ri))
+            if len(routes) > 25:
+                print ("    ...")
+        elif event == "reusedRoutes":
+            print ("Reused routes from %s of %s cities" % args)
+        elif event == "unlimitedStopped":
+            print ("Stopped looking for routes with no distance limit at %s routes, after %s steps" % args)
+        elif event == "dominated":
+            print ("Dropped %s of %s routes as dominated for %s-trains" % (args[1], args[2], args[0]))
+        elif event == "improved":
+            print ("Global revenues improved:", args[0])
+        elif event == "solved":
+            stats, routeTable, routes = args
+            print ("Best revenue:", stats.revenue)
+            print ("Best routes for trains %s:" % stats.trains)
+            for ri in routes:
+                print ("    " + routeTable.describe(ri))
+            print (stats.summary())
+        elif event == "adviseTiles":
+            print ("Trying tile lays for:", *args)
+        elif event == "tile":
+            print ("Laying %s at (%d, %d) earns %s" % (args[2].label or args[2].key, args[0], args[1], args[3]))
+        elif event == "adviseStations":
+            print ("Trying stations for:", *args)
+        elif event == "station":
+            print ("A station at (%d, %d) c%d earns %s, costing others %s" % args)
+        elif event == "log":
+            print ("".join(["|   "]*args[0]), *args[1:])
+
+    # what a stop on hx pays in phase. revenues are a number, None, or
+    # (for off-boards) a list by phase.
+    @staticmethod
+    def hexRevenue(hx, phase):
+        rev = hx.revenue
+        if isinstance(rev, int):
+            return rev
+        elif rev == None:
+            return 0
+        else:
+            return rev[phase]
+
+    # a city blocks a company's routes from running through it once
+    # its stations are full and none of them are the company's.
+    # company None (the board-wide graph used by solveAll) is never
+    # blocked; RouteIndex applies each company's blocking to the routes.
+    def isBlocked(self, loc, company):
+        if hex.Hex.isCity(loc[2]) and company != None:
+            hx = self.map.getHex(loc[0], loc[1])
+            assert hx != None
+
+            cidx = int(loc[2][1:])
+            city = hx.cities[cidx]
+
+            if None in city: return False
+            elif company.id in city: return False
+            else: return True
+        else:
+            return False
+
+    # countsTowns builds the graph for trains that stop at towns;
+    # otherwise towns are just track, with no distance or revenue.
+    # junctions are never stops.
+    def buildGraph(self, company, countsTowns=True):
+        start = time.time()
         self.graph = MapSolver.Graph()
+        self.graph.width = self.map.width
+        self.graph.words = RouteTable.words(self.map.width, self.map.height)
+        self.countsTowns = countsTowns
 
         def getDistance(loc):
-            # count cities and towns
-            return 0 if hex.Hex.isHexside(loc[2]) else 1
+            # count cities (and off-boards) and towns
+            if hex.Hex.isHexside(loc[2]) or hex.Hex.isJunction(loc[2]):
+                return 0
+            elif hex.Hex.isTown(loc[2]) and not countsTowns:
+                return 0
+            else:
+                return 1
 
         def getRevenue(loc):
-            # count cities and towns
-            if hex.Hex.isHexside(loc[2]):
+            # count cities (and off-boards) and towns
+            if getDistance(loc) == 0:
                 return 0
             else:
-                rev = self.map.getHex(loc[0], loc[1]).revenue
-                if isinstance(rev, int):
-                    return rev
-                elif rev == None:
-                    return 0
-                else:
-                    return rev[self.map.getPhase()]
+                return MapSolver.hexRevenue(self.map.getHex(loc[0], loc[1]), self.map.getPhase())
 
         def getStop(loc):
-            if "c" in loc or "t" in loc: return 1
-            else: return 0
-
-        def getBlocked(loc, company):
-            if hex.Hex.isCity(loc[2]):
-                hx = self.map.getHex(loc[0], loc[1])
-                assert hx != None
-
-                cidx = int(loc[2][1:])
-                city = hx.cities[cidx]
+            return getDistance(loc)
 
-                if None in city: return False
-                elif company.id in city: return False
-                else: return True
+        def getId(loc):
+            if hex.Hex.isHexside(loc[2]):
+                return RouteTable.hexsideBit(self.graph.width, loc)
             else:
-                return False
-                
+                return RouteTable.nodeId(self.graph.width, loc)
+
         def explore(src):
             r,c,loc = src
             hx = self.map.getHex(r,c)
@@ -95,10 +306,11 @@ class MapSolver:
 
             if src not in self.graph.vertices.keys():
                 self.graph.vertices[src] = MapSolver.Vertex(src,
+                                                            getId(src),
                                                             getRevenue(src),
                                                             getDistance(src),
                                                             getStop(src),
-                                                            getBlocked(src,company))
+                                                            self.isBlocked(src,company))
                 self.graph.edges[src] = []
             
                 # find what this src connects to on the hex and
@@ -143,7 +355,115 @@ class MapSolver:
                 newvertices[loc] = self.graph.vertices[loc]
         self.graph.vertices = newvertices
 
-    def solve(self, company):
+        self.contractGraph()
+        if self.startingCitiesSet != None:
+            self.findTokenDistances()
+
+        self.stats.timings["graph"] += time.time() - start
+
+    # most hexside vertices just pass the track through to the next
+    # one; there is no decision to make there. this collapses each
+    # such chain into one link from a stop (or junction, or a hexside
+    # where the track forks) to the next one, so the route search only
+    # steps between places where something can happen.
+    #
+    # graph.links[src] is a list of (dst, mask, node): the bitmask of
+    # the hexsides the link crosses (see RouteTable.hexsideBit), and
+    # dst's RouteTable.nodeId, or None if dst is a hexside. links that
+    # dead-end in the middle of track are dropped, but graph.reach[src]
+    # still has every hex that any chain out of src enters.
+    def contractGraph(self):
+        for src, dsts in self.graph.edges.items():
+            if hex.Hex.isHexside(src[2]) and len(dsts) == 1:
+                continue
+
+            links = []
+            reach = set()
+            for dst in dsts:
+                mask = 0
+                hexes = set()
+                while True:
+                    hexes.add(dst[:2])
+                    if not hex.Hex.isHexside(dst[2]):
+                        break
+
+                    bit = 1 << self.graph.vertices[dst].id
+                    if mask & bit:
+                        # ran around a loop of plain track
+                        dst = None
+                        break
+                    mask |= bit
+
+                    if len(self.graph.edges[dst]) != 1:
+                        if len(self.graph.edges[dst]) == 0:
+                            dst = None
+                        break
+
+                    dst = self.graph.edges[dst][0]
+
+                reach |= hexes
+                if dst != None:
+                    node = None if hex.Hex.isHexside(dst[2]) else self.graph.vertices[dst].id
+                    links.append( (dst, mask, node) )
+
+            self.graph.links[src] = links
+            self.graph.reach[src] = reach
+
+    # graph.tokenDistance[loc] is the fewest stops a route must go on
+    # to count past loc before it reaches one of the company's
+    # stations (0 at a station), found by a breadth-first search back
+    # along graph.links from the stations. places that can't reach one
+    # at all are left out. it ignores blocked cities and track the
+    # route already used, so it never overestimates.
+    def findTokenDistances(self):
+        sources = collections.defaultdict(list)
+        for src, links in self.graph.links.items():
+            for dst, mask, node in links:
+                sources[dst].append(src)
+
+        # stepping onto a place costs its distance, which is always 0
+        # or 1, so places with no distance go to the front of the queue
+        tokenDistance = dict([ (loc, 0) for loc in self.startingCities if loc in self.graph.vertices ])
+        queue = collections.deque(tokenDistance.keys())
+        while len(queue) > 0:
+            dst = queue.popleft()
+            step = self.graph.vertices[dst].distance
+            for src in sources[dst]:
+                d = tokenDistance[dst] + step
+                if d < tokenDistance.get(src, d + 1):
+                    tokenDistance[src] = d
+                    if step == 0:
+                        queue.appendleft(src)
+                    else:
+                        queue.append(src)
+
+        self.graph.tokenDistance = tokenDistance
+
+    # the cities a route of up to maxDistance can start from: all of
+    # them, less those too far from any station for the route to
+    # reach one (see findTokenDistances)
+    def startCities(self, maxDistance):
+        cities = [ x for x in self.graph.vertices.values() if not hex.Hex.isHexside(x.loc[2]) ]
+        if self.graph.tokenDistance != None and maxDistance != None:
+            cities = [ x for x in cities if x.distance + self.graph.tokenDistance.get(x.loc, maxDistance + 1) <= maxDistance ]
+        return [ x.loc for x in cities ]
+
+    # onImprove, if given, is called with (revenues, routes) as soon as
+    # a better answer is found, routes in the same form that solve
+    # returns them. timeLimit (seconds, counted from the start of the
+    # solve) and nodeLimit (route combinations tried) cut the search
+    # short; the best answer found so far is returned, and
+    # self.provenOptimal says whether the search got to finish. a
+    # nodeLimit always runs the search serially, so that it is
+    # repeatable.
+    #
+    # engine is "bnb" or "milp", which both pick from every route
+    # found up front, or "stream", which finds routes as the search
+    # needs them (see findBestRoutesStreaming).
+    def solve(self, company, engine="bnb", workers=1,
+              onImprove=None, timeLimit=None, nodeLimit=None):
+        self.setBudget(onImprove, timeLimit, nodeLimit)
+
         # constraints:
         #
         # 1) only N cities per train
@@ -161,23 +481,520 @@ class MapSolver:
         #
         # 7) must connect at least two stops
 
-        print ("Optimizing routes for:", company)
-        
+        self.traceEvent("solve", company)
+        self.stats = MapSolver.Stats(engine, company)
+        self.explorations = 0
+        self.numRoutes = 0
+        self.combinations = 0
+        self.searchStart = None
+
+        self.company = company
         self.findStartingCities(company)
 
-        self.buildGraph(company)
+        # no trains, nothing to run
+        if len(company.trains) == 0:
+            self.solved([], 0, [])
+            return 0, []
+
+        if engine == "stream":
+            return self.findBestRoutesStreaming(company, company.trains)
 
-        routes = self.findAllRoutes(max(company.trains))
+        routes = self.findRoutesForTrains(company, company.trains, workers)
+
+        # no point picking from the part of the routes found before a
+        # cancel
+        if self.cancelled:
+            self.provenOptimal = False
+            return 0, []
         
         # bestRevenues, bestRoutes = self.findBestRoutes(company.trains, routes)
 
-        bestRevenues, bestRoutes = self.findBestRoutes2(company.trains, routes)
+        return self.findBestRoutesWith(engine, company.trains, routes, workers)
+
+    # finds the routes for each kind of train (see train.Train) among
+    # trains. whether the train counts towns decides the graph they
+    # run over; the routes for each graph go in one RouteTable, with
+    # its countsTowns column telling them apart, richest first.
+    #
+    # the trains with a distance limit go first, since the search for
+    # those without one is bounded by what the others can earn (see
+    # findUnlimitedRoutes).
+    def findRoutesForTrains(self, company, trains, workers=1):
+        trains = [ train.Train.get(t) for t in trains ]
+
+        routes = []
+        for countsTowns in sorted(set([ t.countsTowns for t in trains if t.distance != None ])):
+            maxDistance = max([ t.distance for t in trains
+                                if t.countsTowns == countsTowns and t.distance != None ])
+            if self.routeIndex != None and company != None:
+                routes.append(self.findIndexedRoutes(company, countsTowns, maxDistance, workers))
+                continue
+
+            self.buildGraph(company, countsTowns)
+
+            if self.routeCache != None:
+                self.routeCache.update(self.map)
+
+            routes.append(self.findAllRoutes(maxDistance, workers))
+
+        for countsTowns in sorted(set([ t.countsTowns for t in trains if t.distance == None ])):
+            self.buildGraph(company, countsTowns)
+            routes.append(self.findUnlimitedRoutes(trains, routes))
+
+        routes = RouteTable.concatenate(routes)
+        routes = routes.take(np.argsort(-routes.revenues, kind="stable"))
+        self.numRoutes = len(routes)
+        self.stats.peakRoutes = max(self.stats.peakRoutes, len(routes))
+        return routes
+
+    # with a route index, a company's routes are picked out of the
+    # routes over the whole board (see RouteIndex), which are only
+    # searched for once for each state of the track.
+    def findIndexedRoutes(self, company, countsTowns, maxDistance, workers=1):
+        self.routeIndex.update(self.map)
+
+        entry = self.routeIndex.lookup(countsTowns, maxDistance)
+        if entry == None:
+            boardRoutes = self.findBoardRoutes(countsTowns, maxDistance, workers)
+            if self.stopped:
+                # only part of the routes, so not for the index
+                entry = RouteIndex.Entry(self.map, maxDistance, boardRoutes)
+            else:
+                entry = self.routeIndex.store(self.map, countsTowns, maxDistance, boardRoutes)
+        self.stats.peakRoutes = max(self.stats.peakRoutes, len(entry.routes))
 
-        return bestRevenues, [set([hex.Hex.canonicalize(loc) for loc in r[2]]) for r in bestRoutes]
+        start = time.time()
+        routes = entry.companyRoutes(self.map, company, maxDistance)
+        self.stats.timings["routes"] += time.time() - start
+        return routes
 
+    # every route over the whole board up to maxDistance, whatever the
+    # stations, from a solver of its own so that this one keeps its
+    # company
+    def findBoardRoutes(self, countsTowns, maxDistance, workers=1):
+        board = MapSolver(self.map, self.routeCache)
+        board.trace = self.trace
+        board.stats = self.stats
+
+        board.company = None
+        board.startingCities = [ (r,c,stop) for r, c, hx in self.map.getHexes()
+                                 for stop in [ "c%d" % ci for ci in range(len(hx.cities)) ] +
+                                             [ "t%d" % ti for ti in range(hx.towns) ] ]
+        board.startingCitiesSet = None
+        board.buildGraph(None, countsTowns)
+
+        if self.routeCache != None:
+            self.routeCache.update(self.map)
+
+        # cancel passes a cancel on to the board's search, which
+        # shares the budget
+        self.boardSolver = board
+        board.cancelled = self.cancelled
+        board.deadline = self.deadline
+        board.numRoutes = self.numRoutes
+        routes = board.findAllRoutes(maxDistance, workers)
+        self.numRoutes = board.numRoutes
+        self.boardSolver = None
+        if board.stopped:
+            self.outOfBudget()
+
+        self.explorations += board.explorations
+        return routes
+
+    # routes for the trains with no distance limit that run over the
+    # current graph. listing every route of any length blows up on a
+    # busy board, but only the routes that could be part of a better
+    # answer than one already in hand are needed. so these come
+    # richest first, from a RouteStream, and the search stops once the
+    # most any route left could earn, plus the most the other trains
+    # could, is no more than a greedy pick of disjoint routes among
+    # those found so far earns. found holds the RouteTables already
+    # found for the other trains, which must include every route they
+    # can run, apart from those of trains with no limit on other
+    # graphs (which leave this without a bound).
+    #
+    # if that takes more than self.unlimitedExplorations steps, the
+    # trains only get the routes found so far, and the answer is not
+    # proven optimal.
+    def findUnlimitedRoutes(self, trains, found):
+        start = time.time()
+        steps = self.explorations
+
+        # routes as long as the longest limited train's on this graph
+        # are in found already
+        shorter = max([ t.distance for t in trains
+                        if t.countsTowns == self.countsTowns and t.distance != None ] + [ -1 ])
+
+        # the stream only gets to the baseline (not running the train)
+        # at its very end, but the trains need it now
+        routes = []
+        if shorter < 0:
+            routes.append(RouteTable.build(self.graph.width, self.graph.words, self.countsTowns,
+                                           [0], [0], [0], [0], [0, 0], []))
+
+        stream = RouteStream(self, None)
+        chunkSize = 16
+        while True:
+            chunk = stream.pull(chunkSize)
+            if chunk == None:
+                break
+            keep = (chunk.distances > shorter) & (chunk.offsets[1:] > chunk.offsets[:-1])
+            routes.append(chunk.take(np.flatnonzero(keep)))
+            self.numRoutes += len(routes[-1])
+            chunkSize = min(chunkSize * 2, 4096)
+
+            bound = stream.bound()
+            if bound == None:
+                break
+            if self.outOfBudget():
+                break
+            if self.explorations - steps > self.unlimitedExplorations:
+                self.traceEvent("unlimitedStopped", sum([ len(r) for r in routes ]), self.explorations - steps)
+                self.provenOptimal = False
+                break
+            if self.unlimitedDone(trains, RouteTable.concatenate(found + routes), bound):
+                break
+
+        routes = RouteTable.concatenate(routes)
+        elapsed = time.time() - start
+        self.stats.timings["routes"] += elapsed
+        self.traceEvent("routes", routes, self.explorations - steps, elapsed)
+        return routes
+
+    # whether no route the stream for findUnlimitedRoutes has left,
+    # each earning at most bound, could be part of a better answer for
+    # trains than the best found among routes
+    def unlimitedDone(self, trains, routes, bound):
+        runnable = [ (routes.countsTowns == t.countsTowns) & t.runnable(routes) for t in trains ]
+
+        # the most each train could earn; those with no limit on this
+        # graph could also run a route still to come
+        most = []
+        for t, ok in zip(trains, runnable):
+            best = routes.revenues[ok].max() if ok.any() else 0
+            if t.distance == None:
+                best = max(best, bound) if t.countsTowns == self.countsTowns else float('inf')
+            most.append(best)
+
+        # the answer in hand
+        order = sorted(range(len(trains)), key=lambda ti: trains[ti].size(), reverse=True)
+        revenue, _ = MapSolver.greedyRoutes(routes, [ runnable[ti] for ti in order ])
+
+        return all([ bound + sum(most) - m <= revenue
+                     for t, m in zip(trains, most)
+                     if t.distance == None and t.countsTowns == self.countsTowns ])
+
+    # a quick answer: the trains in turn (biggest first), each taking
+    # the richest of its routes that doesn't share track with those
+    # taken. runnable holds a boolean array over routes for each
+    # train. returns the revenues and the indices of the routes taken.
+    @staticmethod
+    def greedyRoutes(routes, runnable):
+        revenue = 0
+        picked = []
+        used = np.zeros(routes.masks.shape[1], dtype=routes.masks.dtype)
+        for ok in runnable:
+            free = np.flatnonzero(ok & ~(routes.masks & used).any(axis=1))
+            if len(free) == 0:
+                continue
+            ri = int(free[np.argmax(routes.revenues[free])])
+            revenue += int(routes.revenues[ri])
+            picked.append(ri)
+            used |= routes.masks[ri]
+        return revenue, picked
+
+    # routes holds the routes for each kind of train, as returned by
+    # findRoutesForTrains. this picks out the ones each train can run,
+    # as lists of indices into routes keyed by the train's name.
+    def findRoutesByTrain(self, trains, routes):
+        routesByTrain = {}
+        for t in set(trains):
+            tr = train.Train.get(t)
+            routesByTrain[t] = np.flatnonzero((routes.countsTowns == tr.countsTowns) &
+                                              tr.runnable(routes)).tolist()
+
+        # a lone train just takes its richest route, which is never
+        # dominated. past the budget, the search has no time to save
+        if len(trains) > 1 and not self.outOfBudget():
+            self.pruneDominatedRoutes(routesByTrain)
+
+        return routesByTrain
+
+    def findBestRoutesWith(self, engine, trains, routes, workers=1):
+        engines = { "bnb": lambda: self.findBestRoutes2(trains, routes, workers),
+                    "milp": lambda: self.findBestRoutesMILP(trains, routes) }
+        assert engine in engines.keys(), "unknown engine: %s" % engine
+
+        self.routeTable = routes
+        self.searchStart = time.time()
+        bestRevenues, bestRoutes = engines[engine]()
+
+        return bestRevenues, self.routeLocations(bestRoutes)
+
+    # what a solve running in another thread is up to, for showing
+    # until it is done. while the routes are being found, numRoutes
+    # counts each city's as its search finishes (see findAllRoutes),
+    # so it runs ahead of the number left once duplicates go.
+    def progress(self):
+        board = self.boardSolver
+        if board != None:
+            return "(finding routes, %s so far...)" % board.numRoutes
+        start = self.searchStart
+        if start == None:
+            return "(finding routes, %s so far...)" % self.numRoutes
+        if self.stats.engine == "milp":
+            # HiGHS gives no word until it is done
+            return "(solving MILP over %s routes, %ds...)" % (self.numRoutes, time.time() - start)
+        return "(%s routes, %s combinations...)" % (self.numRoutes, self.combinations)
+
+    # routes are indices into self.routeTable
+    def routeLocations(self, routes):
+        return [ self.routeTable.locations(ri) for ri in routes ]
+
+    def setBudget(self, onImprove=None, timeLimit=None, nodeLimit=None):
+        self.onImprove = onImprove
+        self.deadline = time.time() + timeLimit if timeLimit != None else None
+        self.nodeLimit = nodeLimit
+        self.provenOptimal = True
+        self.stopped = False
+
+    # stops the search as if its budget ran out. safe to call from
+    # another thread while solve is running. the route searches stop
+    # too, and what they found by then stays out of the route cache
+    # and index. searches spread over a process pool run to the end.
+    def cancel(self):
+        self.cancelled = True
+        board = self.boardSolver
+        if board != None:
+            board.cancel()
+
+    # once this returns True it keeps doing so, so a search that
+    # finished without seeing it was not cut short anywhere below
+    def outOfBudget(self):
+        if ((self.deadline != None and time.time() > self.deadline) or
+            (self.nodeLimit != None and self.combinations > self.nodeLimit) or
+            self.cancelled):
+            self.stopped = True
+            self.provenOptimal = False
+        return self.stopped
+
+    def improved(self, revenues, routes):
+        self.traceEvent("improved", revenues, routes)
+        if self.onImprove != None:
+            self.onImprove(revenues, self.routeLocations(routes))
+
+    # fills in self.stats once an engine has its answer, and reports
+    # it. routes are indices into self.routeTable.
+    def solved(self, trains, revenues, routes):
+        self.stats.trains = trains
+        self.stats.revenue = revenues
+        self.stats.provenOptimal = self.provenOptimal
+        self.stats.explorations = self.explorations
+        self.stats.routes = self.numRoutes
+        self.stats.combinations = self.combinations
+        self.stats.memoHits = self.memoHits
+        self.stats.memoMisses = self.memoMisses
+        self.traceEvent("solved", self.stats, self.routeTable, routes)
+
+    # solve for every company at once. the routes over the track
+    # don't depend on the company, so they are found once for the
+    # whole board, and each company picks its own out of them (see
+    # RouteIndex). returns a list of solve() results and a list of
+    # each solve's Stats, both in the order of companies. the search
+    # over the whole board is shared, so it counts towards none of
+    # them.
+    def solveAll(self, companies, engine="bnb", workers=1):
+        self.traceEvent("solveAll", len(companies))
+        if self.routeIndex == None:
+            self.routeIndex = RouteIndex()
+
+        self.fillRouteIndex(companies, engine, workers)
+
+        results = []
+        stats = []
+        for company in companies:
+            results.append(self.solve(company, engine, workers))
+            stats.append(self.stats)
+
+        return results, stats
+
+    # searches the board once for the longest of all the companies'
+    # trains, so that every company finds its routes in the index (the
+    # stream engine finds its own as it goes, as does each company for
+    # trains with no distance limit)
+    def fillRouteIndex(self, companies, engine="bnb", workers=1):
+        self.setBudget()
+        self.stats = MapSolver.Stats(engine)
+        everyTrain = [ train.Train.get(t) for c in companies for t in c.trains ]
+        self.routeIndex.update(self.map)
+        everyTrain = [ t for t in everyTrain if t.distance != None and engine != "stream" ]
+        for countsTowns in sorted(set([ t.countsTowns for t in everyTrain ])):
+            maxDistance = max([ t.distance for t in everyTrain if t.countsTowns == countsTowns ])
+            if self.routeIndex.lookup(countsTowns, maxDistance) == None:
+                self.routeIndex.store(self.map, countsTowns, maxDistance,
+                                      self.findBoardRoutes(countsTowns, maxDistance, workers))
+
+    # ranks the tile lays open to company by what it would earn with
+    # each: every upgrade, in every rotation getUpgrades allows, of
+    # every hex its track reaches from its stations. returns what it
+    # earns as the map stands, and a list of (revenue, row, col, hex)
+    # for the lays, richest first.
+    #
+    # each lay is solved on an overlay of the map (see Map.withHex),
+    # sharing one route cache, so a solve only searches again from the
+    # cities whose routes reach the changed hex. the lays on a hex are
+    # tried one after another, so that the cache only ever differs by
+    # that hex; with workers, the hexes are split between processes,
+    # each with its own copy of the cache.
+    def adviseTiles(self, company, engine="bnb", workers=1):
+        self.traceEvent("adviseTiles", company)
+        if self.routeCache == None:
+            self.routeCache = RouteCache()
+
+        self.stats = MapSolver.Stats(engine, company)
+        self.company = company
+        self.findStartingCities(company)
+        self.buildGraph(company)
+        hexes = sorted(set([ (r, c) for r, c, loc in self.graph.vertices.keys()
+                             if self.map.getHex(r, c) != None ]))
+
+        # the revenue as things stand, which also fills the cache
+        revenue = MapSolver.scoreTiles(self.map, company, engine, self.routeCache, None, None)[0][0]
+
+        if workers == 1:
+            scores = [ MapSolver.scoreTiles(self.map, company, engine, self.routeCache, r, c)
+                       for r, c in hexes ]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=initTileWorker,
+                                                        initargs=(self.map, company, engine,
+                                                                  self.routeCache)) as executor:
+                scores = list(executor.map(tileWorker, hexes))
+
+        options = []
+        for (r, c), hexScores in zip(hexes, scores):
+            upgrades = self.map.getHex(r, c).getUpgrades(r, c, self.map)
+            for tileRevenue, ui, ri in hexScores:
+                options.append( (tileRevenue, r, c, upgrades[ui][ri]) )
+                self.traceEvent("tile", r, c, upgrades[ui][ri], tileRevenue)
+
+        options.sort(key=lambda option: -option[0])
+        return revenue, options
+
+    # what company earns with each lay on the hex at (row, col), as a
+    # list of (revenue, upgrade, rotation) for the hex
+    # getUpgrades()[upgrade][rotation]. row None scores the map as it
+    # stands, as (revenue, None, None).
+    @staticmethod
+    def scoreTiles(map, company, engine, routeCache, row, col):
+        if row == None:
+            lays = [ (map, None, None) ]
+        else:
+            lays = [ (map.withHex(row, col, choice), ui, ri)
+                     for ui, rotations in enumerate(map.getHex(row, col).getUpgrades(row, col, map))
+                     for ri, choice in enumerate(rotations) ]
+
+        scores = []
+        for m, ui, ri in lays:
+            s = MapSolver(m, routeCache)
+            s.trace = None
+            scores.append( (s.solve(company, engine)[0], ui, ri) )
+        return scores
+
+    # ranks the stations company could place: every open slot in a
+    # city its track reaches, where it has no station yet. returns what
+    # it earns as the map stands, and a list of (revenue, row, col,
+    # city, losses) for the stations, richest first, where losses
+    # maps the id of each other company the station would cost revenue
+    # to the amount it would lose.
+    #
+    # a station doesn't change the track, so every company's routes
+    # come from one route index over the board, whatever the stations
+    # (see RouteIndex), and each station is solved on an overlay of the
+    # map (see Map.withStation). only a station that fills a city can
+    # cost another company anything, by blocking it from running
+    # through there, so the other companies are only solved again if
+    # their best routes now run into such a city. with workers, the
+    # stations are split between processes, each with its own copy of
+    # the index.
+    def adviseStations(self, company, engine="bnb", workers=1):
+        self.traceEvent("adviseStations", company)
+        if self.routeIndex == None:
+            self.routeIndex = RouteIndex()
+
+        others = [ c for c in self.map.companies if c.id != company.id and len(c.trains) > 0 ]
+        self.fillRouteIndex([ company ] + others, engine, workers)
+
+        # what everyone earns, and where, as the map stands
+        best = {}
+        for c in [ company ] + others:
+            s = MapSolver(self.map, None, self.routeIndex)
+            s.trace = None
+            best[c.id] = s.solve(c, engine)
+
+        self.stats = MapSolver.Stats(engine, company)
+        self.company = company
+        self.findStartingCities(company)
+        self.buildGraph(company)
+
+        stations = []
+        for r, c, hx in self.map.getHexes():
+            for ci, city in enumerate(hx.cities):
+                loc = (r, c, "c%d" % ci)
+                if loc not in self.graph.vertices.keys() or None not in city or company.id in city:
+                    continue
+                full = city.count(None) == 1
+                affected = [ oi for oi, other in enumerate(others)
+                             if full and other.id not in city and
+                             any([ loc in route for route in best[other.id][1] ]) ]
+                stations.append( ((r, c, ci, city.index(None)), affected) )
+
+        if workers == 1:
+            scores = [ MapSolver.scoreStation(self.map, company, others, engine, self.routeIndex, *station)
+                       for station in stations ]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=initStationWorker,
+                                                        initargs=(self.map, company, others, engine,
+                                                                  self.routeIndex)) as executor:
+                scores = list(executor.map(stationWorker, stations))
+
+        options = []
+        for ((r, c, ci, si), affected), revenues in zip(stations, scores):
+            losses = dict([ (others[oi].id, best[others[oi].id][0] - revenue)
+                            for oi, revenue in zip(affected, revenues[1:])
+                            if revenue < best[others[oi].id][0] ])
+            options.append( (revenues[0], r, c, ci, losses) )
+            self.traceEvent("station", r, c, ci, revenues[0], losses)
+
+        # among stations that earn the same, the ones that cost the
+        # others most come first
+        options.sort(key=lambda option: (-option[0], -sum(option[4].values())))
+        return best[company.id][0], options
+
+    # what company earns with its station in slot station of city at
+    # (row, col), then what each of the others at indices affected
+    # earns, as a list
+    @staticmethod
+    def scoreStation(map, company, others, engine, routeIndex, station, affected):
+        m = map.withStation(*station, company.id)
+
+        revenues = []
+        for c in [ company ] + [ others[oi] for oi in affected ]:
+            s = MapSolver(m, None, routeIndex)
+            s.trace = None
+            revenues.append(s.solve(c, engine)[0])
+        return revenues
+
+    # callers in the route searches check enableLog first, so that
+    # they don't build the arguments for nothing
     def log(self, *args):
         if self.enableLog:
-            print ("".join(["|   "]*self.recursionDepth), *args)
+            self.traceEvent("log", self.recursionDepth, *args)
+
+    def traceEvent(self, event, *args):
+        if self.trace != None:
+            self.trace(event, *args)
 
     # This version is currently unused, but I am keeping it around for
     # now because the same ideas might be useful later. If we process
@@ -298,208 +1115,798 @@ class MapSolver:
         
         return bestRevenues, bestRoutes
         
-    def findBestRoutes2(self, trains, routes):
+    def findBestRoutes2(self, trains, routes, workers=1):
         start = time.time()
         self.combinations = 0
+        self.memoHits = 0
+        self.memoMisses = 0
         self.enableLog = False
 
         # process the biggest trains first
-        trains = sorted(trains)[::-1]
+        trains = sorted(trains, key=lambda t: train.Train.get(t).size())[::-1]
         
+        # an answer to start from, reported before anything slower
+        # runs, which is all there is if the budget runs out before
+        # the search finds anything better
+        seed = MapSolver.greedyRoutes(routes, [ (routes.countsTowns == train.Train.get(t).countsTowns) &
+                                                train.Train.get(t).runnable(routes) for t in trains ])
+        if seed[0] > 0:
+            self.improved(*seed)
+
+        # preprocess routes into lists for each train type
+        routesByTrain = self.findRoutesByTrain(trains, routes)
+
+        if workers == 1 or len(trains) == 0 or self.nodeLimit != None:
+            globalBestRevenues, globalBestRoutes = self.branchAndBound(trains, routesByTrain, seed=seed)
+        else:
+            globalBestRevenues, globalBestRoutes = self.parallelBranchAndBound(trains, routesByTrain, workers, seed)
+
+        ########################################
+        self.stats.timings["search"] += time.time() - start
+        self.stats.naiveCombinations = 1
+        for t in trains:
+            self.stats.naiveCombinations *= len(routesByTrain[t])
+
+        # k identical trains with n routes only need the multisets of
+        # k routes (see branchAndBound)
+        self.stats.reducedCombinations = 1
+        for t, group in itertools.groupby(trains):
+            k = len(list(group))
+            self.stats.reducedCombinations *= math.comb(len(routesByTrain[t]) + k - 1, k)
+
+        self.solved(trains, globalBestRevenues, globalBestRoutes)
+
+        return globalBestRevenues, globalBestRoutes
+
+    # rather than finding every route before the search starts, this
+    # generates each train's routes richest first (see RouteStream)
+    # and hands them to branchAndBound as it asks for them. the search
+    # stops partway down each train's list once the rest can't pay
+    # enough, so most routes are never built, and the first answers
+    # come before the routes are all known.
+    #
+    # dominated routes are pruned as each chunk comes in (see
+    # StreamedRoutes.pull), but the LP bound, the bulk filtering of
+    # conflicting routes and the memo's reachable hexsides need every
+    # route, so they are left out here, and the search runs serially.
+    # without them it tries far more combinations than bnb: on a big
+    # board with many trains it takes many times as long overall, even
+    # though its first answers still come early.
+    def findBestRoutesStreaming(self, company, trains):
+        self.explorations = 0
+        self.numRoutes = 0
+        self.combinations = 0
+        self.memoHits = 0
+        self.memoMisses = 0
+
+        # process the biggest trains first, same as findBestRoutes2
+        trains = sorted(trains, key=lambda t: train.Train.get(t).size())[::-1]
+        kinds = [ train.Train.get(t) for t in trains ]
+
+        # each train distance gets a stream of its own, so a short
+        # train doesn't wait on the longer routes richer than its own
+        routes = StreamedRoutes(self)
+        for countsTowns in sorted(set([ t.countsTowns for t in kinds ])):
+            self.buildGraph(company, countsTowns)
+            for distance in set([ t.distance for t in kinds if t.countsTowns == countsTowns ]):
+                routes.addStream(RouteStream(self, distance))
+
+        self.routeTable = routes
+        self.searchStart = time.time()
+        routesByTrain = dict([ (t, routes.trainRoutes(train.Train.get(t))) for t in set(trains) ])
+
+        start = time.time()
+        bestRevenues, bestRoutes = self.branchAndBound(trains, routesByTrain)
+
+        ########################################
+        self.stats.timings["search"] += time.time() - start
+        self.stats.peakRoutes = max(self.stats.peakRoutes, len(routes))
+        self.solved(trains, bestRevenues, bestRoutes)
+
+        return bestRevenues, self.routeLocations(bestRoutes)
+
+    # a route is dominated if the same train could run another route
+    # that earns at least as much over a subset of its hexsides: any
+    # combination using the first can swap in the second, so the
+    # first can never be needed. this drops them from each train's
+    # list, keeping the lists in (revenue) order.
+    def pruneDominatedRoutes(self, routesByTrain):
+        revenues = self.routeTable.revenueList()
+        masks = self.routeTable.maskInts()
+
+        for t, routes in routesByTrain.items():
+            if len(routes) < 2:
+                continue
+
+            # out of budget: this list and the rest stay as they are
+            if self.outOfBudget():
+                return
+
+            # how many of the routes use each hexside
+            uses = collections.Counter()
+            for ri in routes:
+                if self.outOfBudget():
+                    return
+                uses.update(MapSolver.hexsideBits(masks[ri]))
+
+            # a dominating route comes before the ones it dominates:
+            # richest first, and fewest hexsides first among equals
+            kept = set()
+            byRarest = collections.defaultdict(list)
+
+            order = sorted(routes, key=lambda ri: (-revenues[ri], masks[ri].bit_count()))
+            for k, ri in enumerate(order):
+                # out of budget: the rest go unchecked
+                if self.outOfBudget():
+                    kept.update(order[k:])
+                    break
+
+                if MapSolver.keepUndominated(byRarest, uses, masks[ri]):
+                    kept.add(ri)
+
+            routesByTrain[t] = [ ri for ri in routes if ri in kept ]
+
+            self.stats.prunes["dominated"] += len(routes) - len(kept)
+            self.traceEvent("dominated", t, len(routes) - len(kept), len(routes))
+
+    # the bit of each hexside in mask
+    @staticmethod
+    def hexsideBits(mask):
+        hexsides = []
+        while mask:
+            hexsides.append(mask & -mask)
+            mask &= mask - 1
+        return hexsides
+
+    # whether the route over the hexsides in mask is dominated by one
+    # already kept, given that those come first (see
+    # pruneDominatedRoutes); if not, it is kept too. byRarest holds the
+    # kept routes' masks, each under its hexside that uses (a Counter)
+    # says the fewest routes use: a subset of a route's hexsides must
+    # have its own among them, and the rarer that is, the fewer routes
+    # share it.
+    @staticmethod
+    def keepUndominated(byRarest, uses, mask):
+        hexsides = MapSolver.hexsideBits(mask)
+        if len(byRarest[0]) > 0:
+            return False
+        for h in hexsides:
+            if h in byRarest and any([ a & mask == a for a in byRarest[h] ]):
+                return False
+
+        byRarest[min(hexsides, key=lambda h: (uses[h], h)) if hexsides else 0].append(mask)
+        return True
+
+    # search for the best routes for trains (sorted biggest first),
+    # given the hexsides already used and the revenues/routes of any
+    # trains that were placed before them. returns the best total
+    # found, including revenuesSoFar and routesSoFar. routes are
+    # indices into self.routeTable.
+    #
+    # trains of the same kind are interchangeable, so giving them the
+    # same routes in a different order can't make anything new. each
+    # one only runs routes from its list at or after the position of
+    # the route run by the one before it, which cuts out up to k! of
+    # the combinations for k identical trains. minPosition is that
+    # position for the first train, if one of its kind was placed
+    # already.
+    #
+    # incumbent is an optional shared multiprocessing.Value holding the
+    # best revenues found by any process, so that parallel searches
+    # prune against each other's results. seed is an optional
+    # (revenues, routes) answer already in hand, for all of trains;
+    # the search only looks for better ones.
+    def branchAndBound(self, trains, routesByTrain,
+                       hexsidesUsed=0, revenuesSoFar=0, routesSoFar=[],
+                       incumbent=None, memo=None, minPosition=0, seed=None):
         # enumerate all combinations of routes, aborting once we know
         # the remaining routes can't possibly do better than the best
         # we've currently found
 
-        globalBestRevenues = 0
-        globalBestRoutes = []
-
-        # preprocess routes into lists for each train type
-        routesByTrain = {}
-        for t in set(trains):
-            routesByTrain[t] = []
-
-            for r in routes:
-                if r[1] <= t:
-                    routesByTrain[t].append(r)
+        globalBestRevenues = revenuesSoFar
+        globalBestRoutes = routesSoFar
+        if seed != None and seed[0] > globalBestRevenues:
+            globalBestRevenues, globalBestRoutes = seed
+
+        revenues = self.routeTable.revenueList()
+        masks = self.routeTable.maskInts()
+        prunes = self.stats.prunes
+
+        # routes streamed in as the search runs (see
+        # findBestRoutesStreaming) aren't all known up front
+        streaming = isinstance(self.routeTable, StreamedRoutes)
+
+        # the best routes for the remaining trains only depend on
+        # which of the hexsides their routes could touch are already
+        # used, so we memoize trainLoop on that (very few unique
+        # responses are returned otherwise). reachableHexsides[k] is
+        # the mask of hexsides touched by any route of the last k
+        # trains, or every hexside (-1) when streaming.
+        reachableHexsides = [0] * (len(trains) + 1)
+        for k in range(1, len(trains) + 1):
+            if streaming:
+                reachableHexsides[k] = -1
+                continue
+            reachableHexsides[k] = reachableHexsides[k-1]
+            for ri in routesByTrain[trains[-k]]:
+                reachableHexsides[k] |= masks[ri]
+
+        # trainLoop returns the best revenues and routes it found for
+        # the remaining trains, and an upper bound on what they could
+        # make. the two only differ when part of the search was pruned
+        # away; the bound is what is safe to prune against.
+        #
+        # memo entries are (pruning threshold, revenues, routes,
+        # bound). the result of a search depends on how aggressively
+        # it was pruned, so an entry is only reused when it is exact
+        # or the current search would prune at least as hard, i.e.,
+        # when globalBestRevenues - revenuesSoFar is no smaller than it
+        # was when the entry was stored.
+        if memo == None:
+            memo = collections.OrderedDict()
+
+        lpTrains = self.lpTrains if not streaming and not self.outOfBudget() else None
+        if lpTrains != None:
+            incidence = self.lpIncidence(routesByTrain)
+
+        # each train's routes, their packed hexside masks, and their
+        # revenues negated (so they are in ascending order), for
+        # filtering the routes in bulk
+        vectorRoutes = self.vectorRoutes if not streaming else None
+        if vectorRoutes != None:
+            packed = {}
+            for t, routes in routesByTrain.items():
+                routes = np.array(routes, dtype=np.int64)
+                packed[t] = (routes, self.routeTable.masks[routes], -self.routeTable.revenues[routes])
+
+        def improve(revenues, routes):
+            nonlocal globalBestRevenues, globalBestRoutes
+            globalBestRevenues = revenues
+            globalBestRoutes = routes
+            self.improved(globalBestRevenues, globalBestRoutes)
+
+            if incumbent != None:
+                with incumbent.get_lock():
+                    incumbent.value = max(incumbent.value, globalBestRevenues)
 
         def trainLoop(hexsidesUsed, remainingTrains,
-                      revenuesSoFar, routesSoFar):
+                      revenuesSoFar, routesSoFar, minPosition=0):
             if len(remainingTrains) == 0:
-                return 0, []
+                return 0, [], 0
             
-            nonlocal globalBestRevenues, globalBestRoutes, routes
+            nonlocal globalBestRevenues
+
+            # prune against whatever the other processes have found
+            if incumbent != None and incumbent.value > globalBestRevenues:
+                globalBestRevenues = incumbent.value
+
+            key = (len(remainingTrains),
+                   hexsidesUsed & reachableHexsides[len(remainingTrains)],
+                   minPosition)
+            if key in memo and (globalBestRevenues - revenuesSoFar >= memo[key][0] or
+                                memo[key][1] == memo[key][3]):
+                self.memoHits += 1
+                memo.move_to_end(key)
+                _, bestRevenues, bestRoutes, bound = memo[key]
+
+                if revenuesSoFar + bestRevenues > globalBestRevenues:
+                    improve(revenuesSoFar + bestRevenues, routesSoFar + bestRoutes)
+
+                return bestRevenues, bestRoutes, bound
+            self.memoMisses += 1
+
             self.recursionDepth += 1
 
             currTrainRoutes = routesByTrain[remainingTrains[0]]
-            uniqueSolutionsForRemainingTrains = set()
             bestRevenues = 0
             bestRoutes = []
+            bound = 0
+
+            # the next train is this one's twin (see above)
+            twin = len(remainingTrains) > 1 and remainingTrains[1] == remainingTrains[0]
 
             # compute the maximum value of remaining trains by
-            # assuming this train does not run at all
-            bestRemainingRevenues, _ = trainLoop(hexsidesUsed,
+            # assuming this train does not run at all. this leaves the
+            # next train free to run anything, so that it bounds the
+            # remaining trains whatever this one runs.
+            _, _, bestRemainingBound = trainLoop(hexsidesUsed,
                                                  remainingTrains[1:],
                                                  revenuesSoFar + 0,
                                                  routesSoFar + [])
+
+            # near the top of the search, bound each route by the LP
+            # relaxation of what's left
+            lp = None
+            if (lpTrains != None and (len(remainingTrains) >= lpTrains or len(routesSoFar) == 0) and
+                not self.outOfBudget()):
+                lp = self.lpRelaxation(remainingTrains, incidence, hexsidesUsed)
+
+            # the routes to try, with their positions in the list
+            candidates = enumerate(itertools.islice(currTrainRoutes, minPosition, None), minPosition)
+
+            # on a long list, find where the routes stop paying enough
+            # (the cut-off below) with a binary search, and drop the
+            # ones before it that conflict in one go, so the loop only
+            # sees routes that can run
+            if vectorRoutes != None and len(currTrainRoutes) >= vectorRoutes:
+                routes, routeMasks, negRevenues = packed[remainingTrains[0]]
+                cut = np.searchsorted(negRevenues, bestRemainingBound + revenuesSoFar - globalBestRevenues,
+                                      side="right")
+                if cut < len(routes):
+                    bound = max(bound, revenues[routes[cut]] + bestRemainingBound)
+                    prunes["bound"] += 1
+
+                used = RouteTable.packMask(hexsidesUsed, routeMasks.shape[1])
+                positions = minPosition + np.flatnonzero(~(routeMasks[minPosition:cut] & used).any(axis=1))
+                prunes["filtered"] += max(0, int(cut) - minPosition) - len(positions)
+                candidates = zip(positions.tolist(), routes[positions].tolist())
                 
-            for r in currTrainRoutes:
+            for position, ri in candidates:
+                if self.outOfBudget(): break
                 self.combinations += 1
+
+                if revenues[ri] + bestRemainingBound + revenuesSoFar < globalBestRevenues:
+                    # self.log("Stopping early: %s + %s + %s = %s < %s" %
+                    #          (revenues[ri], bestRemainingBound, revenuesSoFar,
+                    #           revenues[ri] + bestRemainingBound + revenuesSoFar,
+                    #           globalBestRevenues))
+                    # neither this route nor any later one pays enough,
+                    # whether or not it conflicts
+                    bound = max(bound, revenues[ri] + bestRemainingBound)
+                    prunes["bound"] += 1
+                    break
                 
-                if r[3] & hexsidesUsed != set(): continue
+                if masks[ri] & hexsidesUsed:
+                    prunes["conflict"] += 1
+                    continue
+
+                if lp != None:
+                    routeBound = lp[1].get(ri, lp[0])
+                    if revenuesSoFar + routeBound <= globalBestRevenues:
+                        prunes["lp"] += 1
+                        bound = max(bound, routeBound)
+                        continue
 
-                currRevenues = r[0]
-                currRoutes = [r]
+                currRevenues = revenues[ri]
+                currRoutes = [ri]
 
-                remainingRevenues, remainingRoutes = \
-                    trainLoop(hexsidesUsed | r[3],
+                remainingRevenues, remainingRoutes, remainingBound = \
+                    trainLoop(hexsidesUsed | masks[ri],
                               remainingTrains[1:],
                               revenuesSoFar + currRevenues,
-                              routesSoFar + currRoutes)
-
-                # # TODO: Very few unique responses are being
-                # # returned! We should be able to memoize very
-                # # effectively.
-                # #
-                # # The challenge is that we need to compute all of
-                # # the reachable hexsides so we can say whether a
-                # # given result can be returned early without any
-                # # add'l processing.
-                # numUniqueResponses = len(uniqueSolutionsForRemainingTrains)
-                # uniqueSolutionsForRemainingTrains.add(tuple((x[0], tuple(x[3])) for x in remainingRoutes))
-                # if len(uniqueSolutionsForRemainingTrains) > numUniqueResponses:
-                #     print("".join([" "] * (10 - 2 * len(remainingTrains))),
-                #           "%s unique responses" % len(uniqueSolutionsForRemainingTrains))
+                              routesSoFar + currRoutes,
+                              position if twin else 0)
 
+                bound = max(bound, currRevenues + remainingBound)
                 if currRevenues + remainingRevenues > bestRevenues:
                     bestRevenues = currRevenues + remainingRevenues
                     bestRoutes = currRoutes + remainingRoutes
 
                 if revenuesSoFar + bestRevenues > globalBestRevenues:
-                    globalBestRevenues = revenuesSoFar + bestRevenues
-                    globalBestRoutes = routesSoFar + bestRoutes
-                    print ("Global revenues improved:", globalBestRevenues)
+                    improve(revenuesSoFar + bestRevenues, routesSoFar + bestRoutes)
 
-                if r[0] + bestRemainingRevenues + revenuesSoFar < globalBestRevenues:
-                    # self.log("Stopping early: %s + %s + %s = %s < %s" %
-                    #          (r[0], bestRemainingRevenues, revenuesSoFar,
-                    #           r[0] + bestRemainingRevenues + revenuesSoFar,
-                    #           globalBestRevenues))
-                    break
+            if lp != None:
+                bound = min(bound, lp[0])
+
+            # a search cut short by the budget isn't the real answer
+            if not self.outOfBudget():
+                memo[key] = (globalBestRevenues - revenuesSoFar, bestRevenues, bestRoutes, bound)
+                memo.move_to_end(key)
+                if len(memo) > self.memoSize:
+                    memo.popitem(last=False)
 
             self.recursionDepth -= 1
-            return bestRevenues, bestRoutes
+            return bestRevenues, bestRoutes, bound
 
-        if len(trains) > 0:
-            trainLoop(set(), trains, 0, [])
+        trainLoop(hexsidesUsed, trains, revenuesSoFar, routesSoFar, minPosition)
+
+        return globalBestRevenues, globalBestRoutes
+
+    # the hexsides each train's routes use, as a sparse (hexside bit x
+    # route) matrix and as packed masks, with the routes' indices and
+    # revenues. for lpRelaxation.
+    def lpIncidence(self, routesByTrain):
+        incidence = {}
+        for t, routes in routesByTrain.items():
+            routes = np.array(routes, dtype=np.int64)
+            incidence[t] = (routes, self.routeTable.incidence(routes),
+                            self.routeTable.masks[routes],
+                            self.routeTable.revenues[routes].astype(float))
+
+        return incidence
+
+    # an upper bound on the revenues the trains can make without
+    # the hexsides in hexsidesUsed, from the LP relaxation of picking
+    # routes: each train runs at most one route, and each hexside is
+    # used at most once. this is much tighter than assuming each train
+    # runs its best route, but costs an LP solve, so it is only used at
+    # the top of the search.
+    #
+    # returns the bound and, for each route of the first train, a
+    # bound on the revenues if that route is run, from its reduced
+    # cost. both hold for any non-negative dual prices, so they don't
+    # depend on how exactly the LP was solved. returns None if the
+    # budget runs out before the LP is solved.
+    def lpRelaxation(self, trains, incidence, hexsidesUsed):
+        used = RouteTable.packMask(hexsidesUsed, self.routeTable.masks.shape[1])
+
+        blocks = []
+        for ti, t in enumerate(trains):
+            routes, matrix, masks, revenues = incidence[t]
+            keep = np.flatnonzero((revenues > 0) & ~(masks & used).any(axis=1))
+            blocks.append( (ti, routes[keep], matrix[:, keep], revenues[keep]) )
+
+        variables = sum([ len(routes) for ti, routes, matrix, revenues in blocks ])
+        if variables == 0:
+            return 0, {}
+
+        # one row per train, then one per hexside
+        trainRows = scipy.sparse.csc_array( (np.ones(variables),
+                                             (np.concatenate([ [ti] * len(routes) for ti, routes, matrix, revenues in blocks ]),
+                                              np.arange(variables))),
+                                            shape=(len(trains), variables) )
+        A = scipy.sparse.vstack([ trainRows,
+                                  scipy.sparse.hstack([ matrix for ti, routes, matrix, revenues in blocks ]) ]).tocsr()
+        c = np.concatenate([ revenues for ti, routes, matrix, revenues in blocks ])
+
+        options = {}
+        if self.deadline != None:
+            options["time_limit"] = max(0, self.deadline - time.time())
+        res = scipy.optimize.linprog(-c, A_ub=A, b_ub=np.ones(A.shape[0]), bounds=(0, 1),
+                                     method="highs", options=options)
+
+        # status 1 is running out of time, which leaves no bound
+        if res.status == 1:
+            return None
+        assert res.success, res.message
+
+        # for any x within the constraints and y >= 0,
+        #   c.x <= y.1 + (c - A'y).x <= y.1 + sum(max(c - A'y, 0))
+        # and if route r is run, its own term is exactly its reduced
+        # cost rather than at least zero
+        y = np.maximum(-res.ineqlin.marginals, 0)
+        reducedCosts = c - A.T @ y
+        bound = y.sum() + np.maximum(reducedCosts, 0).sum()
+
+        # revenues are whole numbers
+        def floor(x):
+            return int(math.floor(x + 1e-6))
+
+        routeBounds = {}
+        offset = 0
+        for ti, routes, matrix, revenues in blocks:
+            if ti == 0:
+                for k, ri in enumerate(routes.tolist()):
+                    routeBounds[ri] = floor(bound + min(reducedCosts[offset + k], 0))
+            offset += len(routes)
+
+        return floor(bound), routeBounds
+
+    # split the top level of the search --- the routes of the biggest
+    # train --- across a process pool. every branch below it is
+    # independent except for the best revenues found so far, which
+    # the workers share through a multiprocessing.Value.
+    def parallelBranchAndBound(self, trains, routesByTrain, workers, seed=(0, [])):
+        # the branch where the biggest train doesn't run gives the
+        # bound used to cut off the top level, same as in trainLoop,
+        # and seeds the shared incumbent, unless seed is better
+        bestRemainingRevenues, bestRemainingRoutes = self.branchAndBound(trains[1:], routesByTrain)
+        incumbent = multiprocessing.Value('q', max(bestRemainingRevenues, seed[0]))
+
+        # the columns of the route table that the search reads go to
+        # the workers in shared memory rather than being pickled: one
+        # row per route holding its revenue, then its hexside mask
+        routes = self.routeTable
+        words = routes.masks.shape[1]
+        shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, len(routes) * (1 + words) * 8))
+        table = np.ndarray((len(routes), 1 + words), dtype=np.uint64, buffer=shm.buf)
+        table[:, 0] = routes.revenues
+        table[:, 1:] = routes.masks
+
+        # each train's routes are already indices into the table, and
+        # the top-level branches are the biggest train's routes, in
+        # the same (revenue) order as trainLoop. each branch carries
+        # its position in that list, for when the next train is
+        # identical (see branchAndBound), and the LP bound on its
+        # revenues, as at the root of branchAndBound.
+        lp = None
+        if self.lpTrains != None and not self.outOfBudget():
+            lp = self.lpRelaxation(trains, self.lpIncidence(routesByTrain), 0)
+        if lp == None:
+            lp = (float('inf'), {})
+        branches = [ (ri, position, lp[1].get(ri, lp[0])) for position, ri in enumerate(routesByTrain[trains[0]]) ]
+
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=initBranchWorker,
+                                                        initargs=(shm.name, table.shape, trains, routesByTrain,
+                                                                  incumbent, self.memoSize, self.lpTrains,
+                                                                  self.deadline)) as executor:
+                # results come back in branch order as they finish, so
+                # improvements are passed on while the search runs
+                bestRevenues, bestRoutes = bestRemainingRevenues, bestRemainingRoutes
+                if seed[0] > bestRevenues:
+                    bestRevenues, bestRoutes = seed
+                for result in executor.map(functools.partial(branchWorker, bestRemainingRevenues),
+                                           branches, chunksize=16):
+                    if self.outOfBudget() and incumbent.value < 2**62:
+                        # the workers can't see a cancel; an incumbent
+                        # nothing can beat makes them prune the rest
+                        with incumbent.get_lock():
+                            incumbent.value = 2**62
+
+                    if result == None: continue
+
+                    revenues, indices, combinations, memoHits, memoMisses, prunes, provenOptimal = result
+                    self.combinations += combinations
+                    self.memoHits += memoHits
+                    self.memoMisses += memoMisses
+                    for reason, count in prunes.items():
+                        self.stats.prunes[reason] += count
+                    self.provenOptimal = self.provenOptimal and provenOptimal
+
+                    if revenues > bestRevenues:
+                        bestRevenues = revenues
+                        bestRoutes = indices
+                        self.improved(bestRevenues, bestRoutes)
+        finally:
+            del table
+            shm.close()
+            shm.unlink()
+
+        return bestRevenues, bestRoutes
+
+    def findBestRoutesMILP(self, trains, routes):
+        start = time.time()
+        self.combinations = 0
+        self.memoHits = 0
+        self.memoMisses = 0
+
+        # process the biggest trains first, same as findBestRoutes2
+        trains = sorted(trains, key=lambda t: train.Train.get(t).size())[::-1]
+
+        routesByTrain = self.findRoutesByTrain(trains, routes)
+
+        # trains of the same kind run the same routes, so each kind
+        # gets one variable per route it can run, and a row letting it
+        # run at most as many routes as it has trains. where the kinds
+        # running over a graph form a chain, each able to run every
+        # route the one before can (as a 4-train can a 3-train's), a
+        # route needs just one variable: a route that only the j'th
+        # kind on can run counts against the trains of those kinds,
+        # one row for each j, and those rows are enough for the routes
+        # picked to fit the trains (Hall's theorem, for a chain of
+        # sets). the empty baseline route is left out; a train that
+        # doesn't run just leaves its share of a row unused.
+        distances = self.routeTable.distances
+        variables = []
+        rows, columns, capacities = [], [], []
+        for countsTowns in sorted(set([ train.Train.get(t).countsTowns for t in trains ])):
+            kinds = sorted([ t for t in set(trains) if train.Train.get(t).countsTowns == countsTowns ],
+                           key=lambda t: train.Train.get(t).size())
+            runnable = [ (routes.countsTowns == countsTowns) & train.Train.get(t).runnable(routes)
+                         for t in kinds ]
+
+            if all([ not (runnable[j - 1] & ~runnable[j]).any() for j in range(1, len(kinds)) ]):
+                # dominated routes were dropped for each kind alone,
+                # so take every route left for any of them
+                graphRoutes = np.array(sorted(set([ ri for t in kinds for ri in routesByTrain[t]
+                                                    if distances[ri] > 0 ])), dtype=np.int64)
+                for j in range(len(kinds)):
+                    later = np.flatnonzero(~runnable[j - 1][graphRoutes]) if j > 0 else np.arange(len(graphRoutes))
+                    rows += [ len(capacities) ] * len(later)
+                    columns += (later + len(variables)).tolist()
+                    capacities.append(sum([ trains.count(t) for t in kinds[j:] ]))
+                variables += graphRoutes.tolist()
+            else:
+                for t in kinds:
+                    kindRoutes = [ ri for ri in routesByTrain[t] if distances[ri] > 0 ]
+                    rows += [ len(capacities) ] * len(kindRoutes)
+                    columns += range(len(variables), len(variables) + len(kindRoutes))
+                    capacities.append(trains.count(t))
+                    variables += kindRoutes
+
+        bestRevenues = 0
+        bestRoutes = []
+        hexsideCount = 0
+
+        if len(variables) > 0:
+            # constraint rows: first the ones above, then one per
+            # hexside that any route uses (no shared track)
+            hexsides = self.routeTable.incidence(variables)
+            hexsides = hexsides[np.unique(hexsides.indices), :]
+            hexsideCount = hexsides.shape[0]
+            kindRows = scipy.sparse.csc_array( (np.ones(len(rows)), (rows, columns)),
+                                               shape=(len(capacities), len(variables)) )
+            A = scipy.sparse.vstack([ kindRows, hexsides ]).tocsr()
+            upper = np.concatenate([ capacities, np.ones(hexsideCount) ])
+            revenues = self.routeTable.revenues[variables].astype(float)
+
+            options = {}
+            if self.deadline != None:
+                options["time_limit"] = max(0, self.deadline - time.time())
+
+            # the LP relaxation is nearly always tight here, but HiGHS
+            # can spend far longer finding routes that earn its bound
+            # than the bound takes. so round the LP answer first:
+            # taking routes by how much of each it runs, while they
+            # fit, starting from each route it runs at all in turn
+            lp = scipy.optimize.linprog(-revenues, A_ub=A, b_ub=upper, bounds=(0, 1),
+                                        method="highs", options=options)
+            keep = np.arange(len(variables))
+            if lp.status == 0:
+                byColumn = A.tocsc()
+                columnRows = [ byColumn.indices[byColumn.indptr[vi]:byColumn.indptr[vi + 1]].tolist()
+                               for vi in range(len(variables)) ]
+                capacityList = upper.astype(int).tolist()
+
+                def pick(order):
+                    used = [ 0 ] * len(capacityList)
+                    picked = []
+                    for vi in order:
+                        if all([ used[r] < capacityList[r] for r in columnRows[vi] ]):
+                            for r in columnRows[vi]:
+                                used[r] += 1
+                            picked.append(vi)
+                            if len(picked) == len(trains):
+                                break
+                    return picked
+
+                order = np.lexsort((-revenues, -lp.x)).tolist()
+                for first in np.flatnonzero(lp.x > 1e-6).tolist():
+                    picked = pick([ first ] + [ vi for vi in order if vi != first ])
+                    revenue = int(sum([ self.routeTable.revenues[variables[vi]] for vi in picked ]))
+                    if revenue > bestRevenues:
+                        bestRevenues = revenue
+                        bestRoutes = [ variables[vi] for vi in picked ]
+                if len(bestRoutes) > 0:
+                    self.improved(bestRevenues, bestRoutes)
+
+                # a route whose reduced cost takes the bound below the
+                # rounded answer can't be part of a better one
+                bound = -lp.fun
+                keep = np.flatnonzero(bound - lp.lower.marginals >= bestRevenues - 0.5)
+                if bestRevenues >= bound - 1e-6:
+                    keep = keep[:0]
+
+            if len(keep) > 0:
+                if self.nodeLimit != None:
+                    options["node_limit"] = self.nodeLimit
+                if self.deadline != None:
+                    options["time_limit"] = max(0, self.deadline - time.time())
+
+                res = scipy.optimize.milp(-revenues[keep],
+                                          constraints=scipy.optimize.LinearConstraint(A[:, keep], 0, upper),
+                                          integrality=np.ones(len(keep)),
+                                          bounds=scipy.optimize.Bounds(0, 1),
+                                          options=options)
+                # status 1 is running out of time or nodes, which may
+                # still leave a feasible answer
+                assert res.success or res.status == 1, res.message
+                self.provenOptimal = self.provenOptimal and res.success
+
+                if res.x is not None and -res.fun > bestRevenues + 0.5:
+                    bestRoutes = [ variables[vi] for vi in keep[np.flatnonzero(res.x > 0.5)] ]
+                    bestRevenues = int(sum([ self.routeTable.revenues[ri] for ri in bestRoutes ]))
+                    self.improved(bestRevenues, bestRoutes)
 
         ########################################
-        elapsed = time.time() - start        
-        naiveCombinations = 1
-        for t in trains:
-            naiveCombinations *= len(routesByTrain[t])
+        self.stats.timings["search"] += time.time() - start
+        self.stats.milpVariables = len(variables)
+        self.stats.milpConstraints = hexsideCount
+        self.solved(trains, bestRevenues, bestRoutes)
 
-        print ("Best revenue:", globalBestRevenues)
-        print ("Best routes for trains %s:" % trains)
-        for r in globalBestRoutes:
-            print ("    Revenue: %s, Stops: %s, Hexsides: %s" % (r[0], [ (r,c) for r,c,s in r[2] if isinstance(s,str) ], r[3]))
-        print ("(Tried %s combinations (%.2g%% of %s) in %4g seconds)" %
-               (self.combinations, 100. * self.combinations / naiveCombinations,
-                naiveCombinations, elapsed))
+        return bestRevenues, bestRoutes
 
-        return globalBestRevenues, globalBestRoutes
-    
-    def findAllRoutes(self, maxDistance):
+    # workers > 1 (or None, for one per core) spreads the per-city
+    # searches over a process pool. canonical=False falls back to
+    # searching outward from every city and de-dupping the results.
+    def findAllRoutes(self, maxDistance, workers=1, canonical=True):
         start = time.time()
-        self.explorations = 0
+        steps = self.explorations
         self.recursionDepth += 1
-        self.log("findAllRoutes(%s)" % (maxDistance))
+        self.log("findAllRoutes(%s)" % maxDistance)
 
         # baseline option is not to run this train at all...
-        routes = [ (0, 0, [], set()) ]
+        baseline = RouteTable.build(self.graph.width, self.graph.words, self.countsTowns,
+                                    [0], [0], [0], [0], [0, 0], [])
+
+        # try starting this train at every city close enough to one
+        # of the company's stations, merge the results
+        allCities = self.startCities(maxDistance)
+
+        # canonical searches from cities whose neighbourhood hasn't
+        # changed since the last solve can be reused as-is, as long
+        # as the places where they were cut off for being too far from
+        # a station still are (see findCanonicalRoutesFromCity)
+        if canonical and self.routeCache != None:
+            cachedRoutes = self.routeCache.lookup(self.company, maxDistance, self.countsTowns)
+        else:
+            cachedRoutes = {}
+
+        def cached(city):
+            if city not in cachedRoutes.keys():
+                return False
+            tokenDistance = self.graph.tokenDistance or {}
+            return all([ tokenDistance.get(loc, math.inf) >= d for loc, d in cachedRoutes[city][2].items() ])
 
-        # dictionary indexed by revenue that stores the set of
-        # hexsides used by all routes found at that revenue. used for
-        # merging.
-        hexsidesUsedByRevenue = {}
+        searchCities = [ city for city in allCities if not cached(city) ]
+        self.numRoutes += sum([ len(cachedRoutes[city][0]) for city in allCities if city not in searchCities ])
 
-        # try starting this train at every possible starting city,
-        # merge the results
-        #
-        # TODO: prune this to the set of reachable cities? or explore
-        # forward and backward?
-        allCities = [ x.loc for x in self.graph.vertices.values() if not hex.Hex.isHexside(x.loc[2]) ]
-        for city in allCities:
-            cityRoutes = self.findAllRoutesFromCity(maxDistance, city)
-
-            # merge --- this ended up getting a little complicated...
-            #
-            # the basic idea is simple though. we want to keep a
-            # sorted list (by revenue) of all unique routes we've
-            # found so far. de-dupping the routes requires us to track
-            # the set of hexsides used by each route.
-            mergedRoutes = []
-            i, j = 0, 0
-            while i < len(routes) and j < len(cityRoutes):
-                if routes[i][0] < cityRoutes[j][0]:
-                    next = routes[i]
-                    i += 1
-                elif routes[i][0] > cityRoutes[j][0]:
-                    next = cityRoutes[j]
-                    j += 1
-                else:
-                    # equal revenue; check if we have a duplicate
-                    # route, and skip it if so
-                    assert cityRoutes[j][0] in hexsidesUsedByRevenue.keys()
-                    if tuple(cityRoutes[j][3]) in hexsidesUsedByRevenue[ cityRoutes[j][0] ]:
-                        # already have this; skip it
-                        next = None
-                    else:
-                        # new route; add it
-                        next = cityRoutes[j]
-                    j += 1
-
-                if next != None:
-                    mergedRoutes.append(next)
-                    if next[0] not in hexsidesUsedByRevenue.keys():
-                        hexsidesUsedByRevenue[next[0]] = set()
-                    hexsidesUsedByRevenue[ next[0] ].add(tuple(next[3]))
-
-            mergedRoutes += routes[i:]
-            mergedRoutes += cityRoutes[j:]
-            for r in cityRoutes[j:]:
-                if r[0] not in hexsidesUsedByRevenue.keys():
-                    hexsidesUsedByRevenue[r[0]] = set()
-                hexsidesUsedByRevenue[r[0]].add(tuple(r[3]))
-                
-            routes = mergedRoutes
+        def search(city):
+            if canonical:
+                footprint = set()
+                cuts = {}
+                result = self.findCanonicalRoutesFromCity(maxDistance, city, footprint, cuts), footprint, cuts
+            else:
+                result = self.findAllRoutesFromCity(maxDistance, city), None, None
+            self.numRoutes += len(result[0])
+            return result
+
+        if workers == 1:
+            results = [ search(city) for city in searchCities ]
+        else:
+            # each city's search is independent. the graph goes to
+            # each worker once through the initializer, and map()
+            # hands results back in allCities order so the merge below
+            # is deterministic.
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=initRouteWorker,
+                                                        initargs=(self.graph, self.startingCitiesSet,
+                                                                  self.countsTowns)) as executor:
+                results = []
+                for result in executor.map(functools.partial(findAllRoutesFromCityWorker, maxDistance, canonical),
+                                           searchCities):
+                    self.explorations += result[-1]
+                    self.numRoutes += len(result[0])
+                    results.append(result[:-1])
+
+        # a search cut short by a cancel or the budget stops partway
+        # (see outOfBudget), so what it found must not be cached
+        if canonical and self.routeCache != None:
+            found = dict(zip(searchCities, results))
+            if not self.stopped:
+                cachedRoutes.update(found)
+            self.traceEvent("reusedRoutes", len(allCities) - len(searchCities), len(allCities))
+            allCityRoutes = [ found[city][0] if city in found else cachedRoutes[city][0] for city in allCities ]
+        else:
+            allCityRoutes = [ result[0] for result in results ]
+
+        # the canonical search finds no route twice, but different
+        # paths over the same hexsides (e.g. taking a loop the other
+        # way around) are still interchangeable, so keep only one of
+        # each. the searches from every city find each route once
+        # from each end.
+        routes = RouteTable.concatenate([ baseline ] + allCityRoutes).unique()
 
         self.recursionDepth -= 1
-        routes = routes[::-1]
 
         ########################################
         elapsed = time.time() - start
-        print ("Found %s routes in %s steps and %4g seconds:" % (len(routes), self.explorations, elapsed))
-        for r in routes[:25]:
-            print ("    Revenue: %s, Stops: %s, Hexsides: %s" % (r[0], [ (r,c) for r,c,s in r[2] if isinstance(s,str) ], r[3]))
-        if len(r) > 25:
-            print ("    ...")
+        self.stats.timings["routes"] += elapsed
+        self.stats.peakRoutes = max(self.stats.peakRoutes, len(routes))
+        self.traceEvent("routes", routes, self.explorations - steps, elapsed)
                
         return routes
 
     def findAllRoutesFromCity(self, maxDistance, city):
         self.recursionDepth += 1
-        self.log("Exploring up to distance %s from %s." % (maxDistance, city))
+        if self.enableLog:
+            self.log("Exploring up to distance %s from %s." % (maxDistance, city))
 
         route = [city]
         revenue = self.graph.vertices[city].revenue
         distance = self.graph.vertices[city].distance
-        stops = 1
+        stops = self.graph.vertices[city].stop
         hexsidesUsed = set()
         stopsHit = set([tuple(city)])
         routes = sortedcontainers.SortedList()
 
         def explore():
+            # the clock is only worth reading every so often
             self.explorations += 1
+            if self.stopped or (self.explorations & 255 == 0 and self.outOfBudget()):
+                return
             
             nonlocal route, revenue, distance, stops, hexsidesUsed, stopsHit, routes
             self.recursionDepth += 1
@@ -508,7 +1915,8 @@ class MapSolver:
 
             for dst in self.graph.edges[src]:
                 dstv = self.graph.vertices[dst]
-                self.log("Step:", dst, dstv)
+                if self.enableLog:
+                    self.log("Step:", dst, dstv)
 
                 if hex.Hex.isHexside(dst[2]):
                     candst = hex.Hex.canonicalize(dst)
@@ -519,7 +1927,8 @@ class MapSolver:
                         continue
                     
                 if distance + dstv.distance > maxDistance:
-                    self.log("Too far.")
+                    if self.enableLog:
+                        self.log("Too far.")
                     continue
 
                 # claim this path so it can't be used by any other routes
@@ -534,7 +1943,8 @@ class MapSolver:
 
                 containsStartingCity = (stopsHit & self.startingCitiesSet != set())
                 valid = containsStartingCity and stops >= 2 and dstv.revenue > 0
-                self.log("Route: %s, rev: %s, dist: %s, stops: %s, valid: %s" % ([route], revenue, distance, stops, valid))
+                if self.enableLog:
+                    self.log("Route: %s, rev: %s, dist: %s, stops: %s, valid: %s" % ([route], revenue, distance, stops, valid))
                 if valid:
                     routes.add( (revenue, distance, copy.copy(route), copy.copy(hexsidesUsed)) )
                     
@@ -559,4 +1969,980 @@ class MapSolver:
         explore()
         
         self.recursionDepth -= 1
-        return routes
+
+        revenues, distances, stops, masks, offsets, nodes = [], [], [], [], [0], []
+        for revenue, distance, route, hexsides in routes:
+            revenues.append(revenue)
+            distances.append(distance)
+            stops.append(sum([ self.graph.vertices[loc].stop for loc in route ]))
+            masks.append(sum([ 1 << self.graph.vertices[h].id for h in hexsides ]))
+            nodes += [ self.graph.vertices[loc].id for loc in route if not hex.Hex.isHexside(loc[2]) ]
+            offsets.append(len(nodes))
+
+        return RouteTable.build(self.graph.width, self.graph.words, self.countsTowns,
+                                revenues, distances, stops, masks, offsets, nodes)
+
+    # canonical version of findAllRoutesFromCity: every route is found
+    # exactly once, from the lowest-ordered city (or town, or
+    # junction) on it, rather than once from each end. stops are
+    # ordered by their (row, col, name) location, so the order doesn't
+    # depend on how the graph was built. the route grows
+    # two arms out of that seed, and neither arm may visit a city
+    # ordered at or below the seed. to avoid finding a route twice
+    # with its arms swapped, the second arm must leave the seed by a
+    # later edge than the first, and routes that end at the seed are
+    # only found with an empty first arm.
+    #
+    # the search runs over the contracted graph.links, so each step
+    # covers a whole stretch of plain track.
+    #
+    # a route that hasn't reached one of the company's stations yet
+    # is cut off once it can't reach one in the distance it has left
+    # (see findTokenDistances), from the end of the arm or, while the
+    # second arm is still to come, from the seed.
+    #
+    # if given, footprint collects every hex the search could step
+    # into, and cuts the token distance of each place the search was
+    # cut off at. the results can only change if one of those hexes
+    # does, or one of those places gets closer to a station.
+    def findCanonicalRoutesFromCity(self, maxDistance, city, footprint=None, cuts=None):
+        self.recursionDepth += 1
+        if self.enableLog:
+            self.log("Exploring up to distance %s around %s." % (maxDistance, city))
+
+        seed = self.graph.vertices[city]
+        if footprint != None:
+            footprint.add(city[:2])
+
+        arms = [ [], [] ]
+        revenue = seed.revenue
+        distance = seed.distance
+        stops = seed.stop
+        hexsidesUsed = 0
+        stopsHit = set([tuple(city)])
+
+        # how many of the company's stations the route runs through,
+        # when tokenDistance is there to cut it off by
+        tokenDistance = self.graph.tokenDistance
+        stations = int(tokenDistance != None and city in self.startingCitiesSet)
+
+        # the columns of the RouteTable this returns
+        revenues, distances, routeStops, masks, offsets, nodes = [], [], [], [], [0], []
+
+        def explore(arm):
+            # the clock is only worth reading every so often
+            self.explorations += 1
+            if self.stopped or (self.explorations & 255 == 0 and self.outOfBudget()):
+                return
+
+            nonlocal revenue, distance, stops, hexsidesUsed, stations
+            self.recursionDepth += 1
+
+            src = arms[arm][-1][0] if len(arms[arm]) > 0 else city
+            links = self.graph.links[src]
+
+            if footprint != None:
+                footprint.update(self.graph.reach[src])
+
+            if arm == 1 and len(arms[1]) == 0 and len(arms[0]) > 0:
+                # the seed is in the middle of the route
+                if seed.blocked:
+                    self.recursionDepth -= 1
+                    return
+                links = links[links.index(arms[0][0])+1:]
+
+            for link in links:
+                dst, mask, node = link
+                dstv = self.graph.vertices[dst]
+                if self.enableLog:
+                    self.log("Step:", dst, dstv)
+
+                if hexsidesUsed & mask:
+                    continue
+                if not hex.Hex.isHexside(dst[2]):
+                    if dst in stopsHit or dst <= city:
+                        continue
+                    
+                if distance + dstv.distance > maxDistance:
+                    if self.enableLog:
+                        self.log("Too far.")
+                    continue
+
+                if tokenDistance != None and stations == 0:
+                    left = maxDistance - distance - dstv.distance
+                    if (tokenDistance.get(dst, math.inf) > left and
+                        (arm == 1 or tokenDistance.get(city, math.inf) > left)):
+                        if self.enableLog:
+                            self.log("Too far from a station.")
+                        if cuts != None:
+                            cuts[dst] = tokenDistance.get(dst, math.inf)
+                            cuts[city] = tokenDistance.get(city, math.inf)
+                        continue
+
+                # claim this path so it can't be used by any other routes
+                arms[arm].append(link)
+                revenue += dstv.revenue
+                distance += dstv.distance
+                stops += dstv.stop
+                hexsidesUsed |= mask
+                if not hex.Hex.isHexside(dst[2]):
+                    stopsHit.add(dst)
+                    if tokenDistance != None:
+                        stations += dst in self.startingCitiesSet
+
+                if arm == 0:
+                    # the first arm ends here; try every second arm
+                    if not hex.Hex.isHexside(dst[2]):
+                        explore(1)
+                else:
+                    # both ends must be stops, but a route can be read
+                    # from either end, so only one of them needs to pay
+                    start = self.graph.vertices[arms[0][-1][0]] if len(arms[0]) > 0 else seed
+                    containsStartingCity = (self.startingCitiesSet == None or
+                                            stopsHit & self.startingCitiesSet != set())
+                    valid = (containsStartingCity and stops >= 2 and dstv.stop > 0 and start.stop > 0 and
+                             (dstv.revenue > 0 or start.revenue > 0))
+                    if valid and not hex.Hex.isHexside(dst[2]):
+                        revenues.append(revenue)
+                        distances.append(distance)
+                        routeStops.append(stops)
+                        masks.append(hexsidesUsed)
+                        nodes.extend([ l[2] for l in arms[0][::-1] if l[2] != None ] + [ seed.id ] +
+                                     [ l[2] for l in arms[1] if l[2] != None ])
+                        offsets.append(len(nodes))
+
+                # now, try to extend the current arm by recursing,
+                # unless the city is blocked
+                if not dstv.blocked:
+                    explore(arm)
+
+                # unwind, iterate
+                if not hex.Hex.isHexside(dst[2]):
+                    stopsHit.remove(dst)
+                    if tokenDistance != None:
+                        stations -= dst in self.startingCitiesSet
+                hexsidesUsed ^= mask
+                stops -= dstv.stop
+                distance -= dstv.distance
+                revenue -= dstv.revenue
+                arms[arm].pop()
+
+            self.recursionDepth -= 1
+            return
+
+        # routes that end at the seed, then routes through it
+        explore(1)
+        explore(0)
+        
+        self.recursionDepth -= 1
+        return RouteTable.build(self.graph.width, self.graph.words, self.countsTowns,
+                                revenues, distances, routeStops, masks, offsets, nodes)
+
+# the routes found by MapSolver, stored by column rather than as one
+# tuple per route, so that the searches over them can work on whole
+# arrays at a time. row ri is one route:
+#
+#   revenues[ri], distances[ri], stops[ri]: what it earns, the distance
+#     it counts, and the number of stops on it
+#   masks[ri]: the hexsides it uses, as a bitmask packed into 64b words
+#   nodes[offsets[ri]:offsets[ri+1]]: the cities, towns and junctions
+#     it runs through, in order
+#   countsTowns[ri]: whether it was found for trains that count towns
+#
+# hexsides and nodes are numbered by where they are on the board (see
+# hexsideBit and nodeId), so tables from different searches of the
+# same board can be mixed freely.
+class RouteTable:
+    def __init__(self, revenues, masks, distances=None, stops=None,
+                 offsets=None, nodes=None, countsTowns=None, width=None):
+        self.revenues = np.asarray(revenues, dtype=np.int64)
+        self.masks = np.asarray(masks, dtype=np.uint64)
+        assert self.masks.ndim == 2 and len(self.masks) == len(self.revenues)
+        self.distances = (np.asarray(distances, dtype=np.int64) if distances is not None else
+                          np.zeros(len(self.revenues), dtype=np.int64))
+        self.stops = (np.asarray(stops, dtype=np.int64) if stops is not None else
+                      np.zeros(len(self.revenues), dtype=np.int64))
+        self.offsets = (np.asarray(offsets, dtype=np.int64) if offsets is not None else
+                        np.zeros(len(self.revenues) + 1, dtype=np.int64))
+        self.nodes = (np.asarray(nodes, dtype=np.int64) if nodes is not None else
+                      np.zeros(0, dtype=np.int64))
+        self.countsTowns = (np.asarray(countsTowns, dtype=bool) if countsTowns is not None else
+                            np.ones(len(self.revenues), dtype=bool))
+        self.width = width
+
+        # python copies of the columns the combination search reads
+        # route by route, made on first use
+        self.revenueCache = None
+        self.maskCache = None
+        self.stopCache = None
+
+    def __len__(self):
+        return len(self.revenues)
+
+    # hexsides are numbered by the hex they are canonically named from
+    # (see hex.Hex.canonicalize), which may be one row or column off
+    # the board, and the side
+    @staticmethod
+    def hexsideBit(width, loc):
+        r, c, side = hex.Hex.canonicalize(loc)
+        return ((r + 1) * (width + 2) + (c + 1)) * 3 + side
+
+    @staticmethod
+    def hexsideLoc(width, bit):
+        cell, side = divmod(bit, 3)
+        return (cell // (width + 2) - 1, cell % (width + 2) - 1, side)
+
+    @staticmethod
+    def words(width, height):
+        return ((height + 2) * (width + 2) * 3 + 63) // 64
+
+    # nodes are numbered by their hex, then their name: "c<n>", "t<n>",
+    # "j<n>", or "None" for an off-board
+    nodeKinds = [ "c", "t", "j", "None" ]
+
+    @staticmethod
+    def nodeId(width, loc):
+        r, c, name = loc
+        if name == "None":
+            kind, number = 3, 0
+        else:
+            kind, number = RouteTable.nodeKinds.index(name[0]), int(name[1:])
+        return ((r + 1) * (width + 2) + (c + 1)) * 64 + number * 4 + kind
+
+    @staticmethod
+    def nodeLoc(width, id):
+        cell, name = divmod(int(id), 64)
+        number, kind = divmod(name, 4)
+        name = "None" if kind == 3 else "%s%d" % (RouteTable.nodeKinds[kind], number)
+        return (cell // (width + 2) - 1, cell % (width + 2) - 1, name)
+
+    # masks are python ints here, and offsets/nodes are the flat node
+    # lists as the searches build them up
+    @staticmethod
+    def build(width, words, countsTowns, revenues, distances, stops, masks, offsets, nodes):
+        packed = np.frombuffer(b"".join([ m.to_bytes(8 * words, "little") for m in masks ]),
+                               dtype="<u8").reshape(len(masks), words)
+        return RouteTable(revenues, packed, distances, stops, offsets, nodes,
+                          [ countsTowns ] * len(revenues), width)
+
+    @staticmethod
+    def concatenate(tables):
+        offsets = [ np.zeros(1, dtype=np.int64) ]
+        base = 0
+        for t in tables:
+            offsets.append(t.offsets[1:] + base)
+            base += t.offsets[-1]
+        return RouteTable(np.concatenate([ t.revenues for t in tables ]),
+                          np.concatenate([ t.masks for t in tables ]),
+                          np.concatenate([ t.distances for t in tables ]),
+                          np.concatenate([ t.stops for t in tables ]),
+                          np.concatenate(offsets),
+                          np.concatenate([ t.nodes for t in tables ]),
+                          np.concatenate([ t.countsTowns for t in tables ]),
+                          tables[0].width)
+
+    # the routes at indices, in that order
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.concatenate([ [0], np.cumsum(lengths) ])
+        # position of every kept node in the old nodes column
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RouteTable(self.revenues[indices], self.masks[indices], self.distances[indices],
+                          self.stops[indices], offsets, self.nodes[positions],
+                          self.countsTowns[indices], self.width)
+
+    # one of each route by revenue, distance and hexsides, keeping the
+    # first found, then sorted richest first. routes that earn the
+    # same come out in the reverse of the order they were found.
+    def unique(self):
+        keys = np.ascontiguousarray(np.column_stack([ self.revenues.view(np.uint64),
+                                                      self.distances.view(np.uint64),
+                                                      self.masks ]))
+        _, first = np.unique(keys.view(np.dtype((np.void, keys.shape[1] * 8))).ravel(),
+                             return_index=True)
+        first.sort()
+        return self.take(first[np.argsort(self.revenues[first], kind="stable")][::-1])
+
+    def revenueList(self):
+        if self.revenueCache == None:
+            self.revenueCache = self.revenues.tolist()
+        return self.revenueCache
+
+    def maskInts(self):
+        if self.maskCache == None:
+            size = 8 * self.masks.shape[1]
+            buf = self.masks.astype("<u8").tobytes()
+            self.maskCache = [ int.from_bytes(buf[i:i+size], "little") for i in range(0, len(buf), size) ]
+        return self.maskCache
+
+    @staticmethod
+    def packMask(mask, words):
+        return np.frombuffer(mask.to_bytes(8 * words, "little"), dtype="<u8")
+
+    # for each route, how many of its nodes have flags (a boolean per
+    # entry of the nodes column) set
+    def count(self, flags):
+        total = np.concatenate([ [0], np.cumsum(flags) ])
+        return total[self.offsets[1:]] - total[self.offsets[:-1]]
+
+    # cities and off-boards on each route
+    def cities(self):
+        kinds = self.nodes % 4
+        return self.count((kinds == 0) | (kinds == 3))
+
+    def nodeLocs(self, ri):
+        return [ RouteTable.nodeLoc(self.width, n) for n in self.nodes[self.offsets[ri]:self.offsets[ri+1]] ]
+
+    def hexsideLocs(self, ri):
+        bits = np.flatnonzero(np.unpackbits(self.masks[ri].astype("<u8").view(np.uint8), bitorder="little"))
+        return [ RouteTable.hexsideLoc(self.width, int(b)) for b in bits ]
+
+    # the route as the set of its (canonical) locations, which is how
+    # solve returns it
+    def locations(self, ri):
+        return set(self.nodeLocs(ri)) | set(self.hexsideLocs(ri))
+
+    def describe(self, ri):
+        return "Revenue: %s, Stops: %s, Hexsides: %s" % (self.revenues[ri],
+                                                          [ (r,c) for r,c,s in self.nodeLocs(ri) ],
+                                                          self.hexsideLocs(ri))
+
+    # the stops on each route, as the node ids of every stop any route
+    # runs through and a sparse (route x stop) matrix of which ones
+    # each route does. made on first use.
+    def stopMatrix(self):
+        if self.stopCache == None:
+            ids, columns = np.unique(self.nodes, return_inverse=True)
+            rows = np.repeat(np.arange(len(self)), self.offsets[1:] - self.offsets[:-1])
+            matrix = scipy.sparse.csr_array( (np.ones(len(rows)), (rows, columns)), shape=(len(self), len(ids)) )
+            self.stopCache = (ids, matrix)
+        return self.stopCache
+
+    # the same routes, with what they earn in the map's current phase.
+    # where a route runs doesn't depend on the phase, only what its
+    # stops pay, so each route's revenue is the sum of its stops':
+    # the stop matrix times a vector of stop revenues.
+    def rescored(self, map):
+        ids, matrix = self.stopMatrix()
+        phase = map.getPhase()
+
+        # junctions pay nothing, and towns only to trains that count
+        # them (see MapSolver.buildGraph)
+        pays = np.zeros(len(ids))
+        for i, id in enumerate(ids):
+            r, c, name = RouteTable.nodeLoc(self.width, id)
+            if not hex.Hex.isJunction(name):
+                pays[i] = MapSolver.hexRevenue(map.getHex(r, c), phase)
+        towns = (ids % 4) == RouteTable.nodeKinds.index("t")
+
+        revenues = np.where(self.countsTowns, matrix @ pays, matrix @ np.where(towns, 0, pays))
+        table = RouteTable(np.rint(revenues), self.masks, self.distances, self.stops,
+                           self.offsets, self.nodes, self.countsTowns, self.width)
+        table.stopCache = self.stopCache
+        return table
+
+    # the hexsides used by the routes at indices, as a sparse (hexside
+    # bit x route) matrix
+    def incidence(self, indices):
+        bits = np.unpackbits(self.masks[indices].astype("<u8").view(np.uint8), axis=1, bitorder="little")
+        return scipy.sparse.csc_array(bits.T.astype(float))
+
+# the routes over the solver's current graph, generated richest first
+# and a few at a time rather than all at once. this is the canonical
+# search of MapSolver.findCanonicalRoutesFromCity run best first: each
+# partial route (one call of its explore) waits on a heap, keyed by the
+# most it could still earn, and a finished route waits keyed by its
+# revenue, so a route comes off the heap only once nothing left on it
+# can pay more.
+#
+# the most a partial route could still earn comes from bestFrom (see
+# findBestFrom): the ends of its arms can't go on to earn more than
+# that with the distance it has left. with no distance limit, that
+# would let a route loop between two rich cities for as long as the
+# graph has stops, so instead it is what the stops it could still
+# reach pay (see reachable).
+class RouteStream:
+    def __init__(self, solver, maxDistance):
+        self.solver = solver
+        self.graph = solver.graph
+        self.countsTowns = solver.countsTowns
+        self.startingCitiesSet = solver.startingCitiesSet
+        self.maxDistance = maxDistance
+
+        # no route can count more stops than the graph has
+        stops = len([ loc for loc, v in self.graph.vertices.items()
+                      if not hex.Hex.isHexside(loc[2]) and v.stop > 0 ])
+        self.distance = min(maxDistance, stops) if maxDistance != None else stops
+        self.bestFrom = self.findBestFrom() if maxDistance != None else None
+
+        # graph.links for reachable, with whether each place they go
+        # to is a hexside, what it pays, and whether it is blocked
+        if self.bestFrom == None:
+            self.reach = dict([ (src, [ (dst, mask, hex.Hex.isHexside(dst[2]), self.graph.vertices[dst].revenue,
+                                         self.graph.vertices[dst].blocked) for dst, mask, node in links ])
+                                for src, links in self.graph.links.items() ])
+
+        self.heap = []
+        self.count = 0
+        self.seen = set()
+
+        # baseline option is not to run the train at all, which pays
+        # less than any other route
+        self.push(0, (0, 0, 0, 0, []))
+
+        # a partial route is (seed, arm, arms, first link of arm 0,
+        # revenue, distance, stops, hexsides used, stops hit), with the
+        # arms' links held as (link, rest of the arm) from their far
+        # end back
+        for city in solver.startCities(self.distance):
+            seed = self.graph.vertices[city]
+            for arm in [1, 0]:
+                self.pushPartial( (city, arm, (None, None), None, seed.revenue,
+                                   seed.distance, seed.stop, 0, frozenset([city])) )
+
+    def push(self, priority, route):
+        # ties go to finished routes, then to whatever came first
+        heapq.heappush(self.heap, (-priority, False, self.count, route, None))
+        self.count += 1
+
+    def pushPartial(self, partial):
+        city, arm, arms, first, revenue, distance = partial[:6]
+        left = max(self.distance - distance, 0)
+        ends = [ arms[a][0][0] if arms[a] != None else city for a in [0, 1] ]
+
+        if self.bestFrom == None:
+            # the second arm can't leave a blocked seed (see explore)
+            seedOpen = arms[0] == None or not self.graph.vertices[city].blocked
+            if arm == 1:
+                bound = self.reachable(partial, [ ends[1] ] if arms[1] != None or seedOpen else [])
+            else:
+                bound = self.reachable(partial, [ ends[0] ] + ([ city ] if seedOpen else []))
+        elif arm == 1:
+            bound = self.bestFrom[ends[1]][left]
+        else:
+            # the rest of the distance is split between the two arms
+            bound = max([ self.bestFrom[ends[0]][d] + self.bestFrom[city][left - d]
+                          for d in range(left + 1) ])
+
+        heapq.heappush(self.heap, (-(revenue + bound), True, self.count, None, partial))
+        self.count += 1
+
+    # bestFrom[src][d] is the most a train could earn going on from
+    # src over graph.links with distance d left, ignoring that it may
+    # not reuse track or stops. that makes it an upper bound on what
+    # any real route can add, and cheap to find: the values for each d
+    # only depend on those for smaller d, except across links to
+    # places with no distance (junctions and track), which are
+    # relaxed until they settle.
+    def findBestFrom(self):
+        bestFrom = dict([ (src, [0] * (self.distance + 1)) for src in self.graph.links.keys() ])
+        for d in range(self.distance + 1):
+            changed = True
+            while changed:
+                changed = False
+                for src, links in self.graph.links.items():
+                    for dst, mask, node in links:
+                        dstv = self.graph.vertices[dst]
+                        if dstv.distance > d:
+                            continue
+                        best = dstv.revenue
+                        if not dstv.blocked:
+                            best += bestFrom[dst][d - dstv.distance]
+                        if best > bestFrom[src][d]:
+                            bestFrom[src][d] = best
+                            changed = True
+        return bestFrom
+
+    # the most any route still to come could earn, or None once there
+    # are none left
+    def bound(self):
+        return -self.heap[0][0] if len(self.heap) > 0 else None
+
+    # the most the partial route could still earn going on from ends:
+    # what every stop it could reach from them pays, each counted
+    # once. like explore, this doesn't reuse the route's hexsides or
+    # stops, go back past the seed, or go on through a blocked city.
+    def reachable(self, partial, ends):
+        city, hexsidesUsed, stopsHit = partial[0], partial[7], partial[8]
+        seen = set(ends)
+        stack = list(ends)
+        revenue = 0
+        while len(stack) > 0:
+            for dst, mask, isHexside, pays, blocked in self.reach[stack.pop()]:
+                if hexsidesUsed & mask or dst in seen:
+                    continue
+                if not isHexside and (dst in stopsHit or dst <= city):
+                    continue
+                seen.add(dst)
+                revenue += pays
+                if not blocked:
+                    stack.append(dst)
+        return revenue
+
+    # the next (at most) count routes, as a RouteTable, or None once
+    # there are none left (or the solve is out of budget)
+    def pull(self, count):
+        revenues, distances, stops, masks, offsets, nodes = [], [], [], [], [0], []
+
+        while len(self.heap) > 0 and len(revenues) < count and not self.solver.outOfBudget():
+            _, _, _, route, partial = heapq.heappop(self.heap)
+            if partial != None:
+                self.explore(partial)
+                continue
+
+            # different paths over the same hexsides are
+            # interchangeable, so keep only one of each
+            key = route[:2] + route[3:4]
+            if key in self.seen: continue
+            self.seen.add(key)
+
+            revenues.append(route[0])
+            distances.append(route[1])
+            stops.append(route[2])
+            masks.append(route[3])
+            nodes += route[4]
+            offsets.append(len(nodes))
+
+        if len(revenues) == 0:
+            return None
+        return RouteTable.build(self.graph.width, self.graph.words, self.countsTowns,
+                                revenues, distances, stops, masks, offsets, nodes)
+
+    # one step of findCanonicalRoutesFromCity's explore: every way to
+    # extend the partial route by one link goes back on the heap
+    def explore(self, partial):
+        city, arm, arms, first, revenue, distance, stops, hexsidesUsed, stopsHit = partial
+        self.solver.explorations += 1
+
+        seed = self.graph.vertices[city]
+        src = arms[arm][0][0] if arms[arm] != None else city
+        links = self.graph.links[src]
+
+        if arm == 1 and arms[1] == None and arms[0] != None:
+            # the seed is in the middle of the route
+            if seed.blocked:
+                return
+            links = links[links.index(first)+1:]
+
+        for link in links:
+            dst, mask, node = link
+            dstv = self.graph.vertices[dst]
+
+            if hexsidesUsed & mask:
+                continue
+            if not hex.Hex.isHexside(dst[2]):
+                if dst in stopsHit or dst <= city:
+                    continue
+
+            if self.maxDistance != None and distance + dstv.distance > self.maxDistance:
+                continue
+
+            step = ( (link, arms[0]) if arm == 0 else arms[0],
+                     (link, arms[1]) if arm == 1 else arms[1] )
+            extended = (city, arm, step, link if first == None and arm == 0 else first,
+                        revenue + dstv.revenue, distance + dstv.distance, stops + dstv.stop,
+                        hexsidesUsed | mask,
+                        stopsHit | set([dst]) if not hex.Hex.isHexside(dst[2]) else stopsHit)
+
+            if not hex.Hex.isHexside(dst[2]):
+                if arm == 0:
+                    # the first arm ends here; try every second arm
+                    self.pushPartial(extended[:1] + (1,) + extended[2:])
+                else:
+                    start = self.graph.vertices[arms[0][0][0]] if arms[0] != None else seed
+                    containsStartingCity = (self.startingCitiesSet == None or
+                                            not self.startingCitiesSet.isdisjoint(extended[8]))
+                    valid = (containsStartingCity and extended[6] >= 2 and dstv.stop > 0 and start.stop > 0 and
+                             (dstv.revenue > 0 or start.revenue > 0))
+                    if valid:
+                        self.push(extended[4], extended[4:8] +
+                                  (RouteStream.armNodes(step[0]) + [ seed.id ] +
+                                   RouteStream.armNodes(step[1])[::-1],))
+
+            # now, try to extend the current arm, unless the city is
+            # blocked
+            if not dstv.blocked:
+                self.pushPartial(extended)
+
+    # the nodes an arm's links end at, from its far end back
+    @staticmethod
+    def armNodes(arm):
+        nodes = []
+        while arm != None:
+            if arm[0][2] != None:
+                nodes.append(arm[0][2])
+            arm = arm[1]
+        return nodes
+
+# the routes of a StreamedRoutes, which stand in for the RouteTable of
+# MapSolver.branchAndBound when streaming (see
+# MapSolver.findBestRoutesStreaming). routes are pulled from their
+# RouteStream in chunks as each train's list is read past its end, so
+# the route indices are in the order the routes were generated. a
+# route found by more than one stream gets an index from each.
+class StreamedRoutes:
+    def __init__(self, solver, chunkSize=16):
+        self.solver = solver
+        self.chunkSize = chunkSize
+        self.streams = []
+        self.trains = []
+        self.revenues = []
+        self.masks = []
+        self.tables = []
+        self.table = None
+
+    def __len__(self):
+        return len(self.revenues)
+
+    def addStream(self, stream):
+        self.streams.append(stream)
+
+    def revenueList(self):
+        return self.revenues
+
+    def maskInts(self):
+        return self.masks
+
+    # the routes tr can run, as an iterable of indices that grows as it
+    # is read
+    def trainRoutes(self, tr):
+        assert len(self.revenues) == 0, "trains must be added before routes are pulled"
+        stream = [ s for s in self.streams
+                   if s.countsTowns == tr.countsTowns and s.maxDistance == tr.distance ][0]
+        indices = []
+        self.trains.append( (tr, stream, indices, collections.Counter(), collections.defaultdict(list)) )
+        return StreamedRoutes.TrainRoutes(self, stream, indices)
+
+    class TrainRoutes:
+        def __init__(self, routes, stream, indices):
+            self.routes = routes
+            self.stream = stream
+            self.indices = indices
+
+        def __len__(self):
+            return len(self.indices)
+
+        def __iter__(self):
+            i = 0
+            while i < len(self.indices) or self.routes.pull(self.stream):
+                if i < len(self.indices):
+                    yield self.indices[i]
+                    i += 1
+
+    # pulls the next chunk of routes from stream onto the end of the
+    # lists of the trains that run over it. returns False once the
+    # stream has run dry.
+    #
+    # the stream gives routes richest first, the order
+    # MapSolver.pruneDominatedRoutes checks them in, so each train's
+    # dominated routes are left off its list as they come. the hexside
+    # counts only cover the routes pulled so far, which only makes the
+    # buckets less even; and a route that comes in a later chunk than
+    # an equally rich one with more hexsides just leaves both kept.
+    def pull(self, stream):
+        routes = stream.pull(self.chunkSize)
+        if routes == None:
+            return False
+
+        base = len(self.revenues)
+        self.revenues += routes.revenueList()
+        self.masks += routes.maskInts()
+        self.tables.append(routes)
+        self.table = None
+        for tr, s, indices, uses, byRarest in self.trains:
+            if s is not stream:
+                continue
+
+            runnable = (base + np.flatnonzero(tr.runnable(routes))).tolist()
+            for ri in runnable:
+                uses.update(MapSolver.hexsideBits(self.masks[ri]))
+
+            runnable.sort(key=lambda ri: (-self.revenues[ri], self.masks[ri].bit_count()))
+            kept = [ ri for ri in runnable if MapSolver.keepUndominated(byRarest, uses, self.masks[ri]) ]
+            self.solver.stats.prunes["dominated"] += len(runnable) - len(kept)
+
+            # the search expects each train's routes in stream order
+            indices += sorted(kept)
+
+        self.solver.numRoutes = len(self.revenues)
+        return True
+
+    def routeTable(self):
+        if self.table == None:
+            self.table = RouteTable.concatenate(self.tables)
+        return self.table
+
+    def locations(self, ri):
+        return self.routeTable().locations(ri)
+
+    def describe(self, ri):
+        return self.routeTable().describe(ri)
+
+# routes found by MapSolver.findCanonicalRoutesFromCity, kept across
+# solves of the same map. each city's routes are stored with the set of
+# hexes its search stepped into, for each company, train size, and
+# whether the trains count towns.
+#
+# the map state is copied wholesale on every change, so rather than
+# tracking the copies, update() compares each hex against what it was
+# at the last solve; a tile lay (Map.updateHex) or token change
+# (Map.updateCity) then only throws out the cities whose searches
+# reached that hex. undo, redo and history work the same way. a phase
+# change (Map.updatePhase) only changes what the routes earn, so the
+# cached routes are rescored rather than searched for again, apart from
+# the searches that reached a stop that only starts paying now (see
+# startedPaying).
+class RouteCache:
+    def __init__(self):
+        self.hexes = {}
+        self.phase = None
+        self.routes = {}
+
+    @staticmethod
+    def signature(hx):
+        return (hx.key, hx.rotation, str(hx.connections), str(hx.cities), str(hx.revenue))
+
+    # the hexes whose stops paid nothing in phase, but do now. a route
+    # has to have an end that pays (see
+    # MapSolver.findCanonicalRoutesFromCity), so the routes ending at
+    # these were never kept, and rescoring can't bring them back.
+    @staticmethod
+    def startedPaying(map, phase):
+        if phase == None or phase == map.getPhase():
+            return set()
+        return set([ (r,c) for r, c, hx in map.getHexes()
+                     if MapSolver.hexRevenue(hx, phase) == 0 and
+                        MapSolver.hexRevenue(hx, map.getPhase()) > 0 ])
+
+    def update(self, map):
+        hexes = { (r,c): RouteCache.signature(hx) for r, c, hx in map.getHexes() }
+
+        changed = set([ loc for loc in set(hexes.keys()) | set(self.hexes.keys())
+                        if hexes.get(loc) != self.hexes.get(loc) ])
+        changed |= RouteCache.startedPaying(map, self.phase)
+        if len(changed) > 0:
+            for cityRoutes in self.routes.values():
+                for city, (routes, footprint, cuts) in list(cityRoutes.items()):
+                    if footprint & changed:
+                        del cityRoutes[city]
+
+        # otherwise a new phase only changes what the routes earn
+        if map.getPhase() != self.phase:
+            for cityRoutes in self.routes.values():
+                for city, (routes, footprint, cuts) in list(cityRoutes.items()):
+                    cityRoutes[city] = (routes.rescored(map), footprint, cuts)
+
+        self.hexes = hexes
+        self.phase = map.getPhase()
+
+    # the cached routes by city for a company and train size. the
+    # caller adds entries for any cities it searches. company None is
+    # the board-wide search used by MapSolver.solveAll.
+    def lookup(self, company, maxDistance, countsTowns=True):
+        key = (company.id if company != None else None, maxDistance, countsTowns)
+        if key not in self.routes.keys():
+            self.routes[key] = {}
+        return self.routes[key]
+
+# every route over the board, whatever the stations, for one state of
+# the track. where a route can run only depends on the track; a
+# company just has to have a station on it, and must not run through
+# a city it is blocked from (see MapSolver.isBlocked). so the index
+# keeps which cities each route visits, and each company's routes are
+# picked out of it, rather than searched for again. stations can come
+# and go without changing the index, and a phase change only rescores
+# the routes (see RouteTable.rescored); a tile lay, or a phase change
+# that makes a stop start paying (see RouteCache.startedPaying), starts
+# it over.
+#
+# there is one entry for trains that count towns and one for those
+# that don't, each holding the routes up to the longest distance asked
+# for so far. trains with no distance limit aren't indexed: every
+# route of any length over the whole board is far more than any one
+# company needs (see MapSolver.findUnlimitedRoutes).
+class RouteIndex:
+    class Entry:
+        def __init__(self, map, maxDistance, routes):
+            self.maxDistance = maxDistance
+            self.routes = routes
+
+            # every city on the board, and whether each route visits
+            # it at all (visits) or runs through it rather than
+            # starting or ending there (through), as sparse (route x
+            # city) matrices
+            self.cities = [ (r, c, "c%d" % ci) for r, c, hx in map.getHexes() for ci in range(len(hx.cities)) ]
+            cityIds = np.array([ RouteTable.nodeId(routes.width, loc) for loc in self.cities ], dtype=np.int64)
+            order = np.argsort(cityIds)
+
+            lengths = routes.offsets[1:] - routes.offsets[:-1]
+            rows = np.repeat(np.arange(len(routes)), lengths)
+            positions = np.arange(len(routes.nodes))
+            through = (positions != routes.offsets[:-1][rows]) & (positions != routes.offsets[1:][rows] - 1)
+
+            found = np.searchsorted(cityIds[order], routes.nodes)
+            isCity = found < len(cityIds)
+            isCity[isCity] = cityIds[order][found[isCity]] == routes.nodes[isCity]
+            columns = order[found[isCity]]
+
+            shape = (len(routes), len(self.cities))
+            self.visits = scipy.sparse.csr_array( (np.ones(len(columns)), (rows[isCity], columns)), shape=shape )
+            self.through = scipy.sparse.csr_array( (through[isCity].astype(float), (rows[isCity], columns)), shape=shape )
+
+        # the routes company can run, up to maxDistance, as a RouteTable
+        def companyRoutes(self, map, company, maxDistance):
+            stations = np.zeros(len(self.cities))
+            blocked = np.zeros(len(self.cities))
+            for k, (r, c, stop) in enumerate(self.cities):
+                city = map.getHex(r, c).cities[int(stop[1:])]
+                stations[k] = company.id in city
+                blocked[k] = None not in city and company.id not in city
+
+            # keep the baseline (empty) route, and any route that runs
+            # from one of the company's stations without being blocked
+            routes = self.routes
+            keep = ((routes.offsets[1:] == routes.offsets[:-1]) |
+                    ((self.visits @ stations > 0) & (self.through @ blocked == 0)))
+            keep &= routes.distances <= maxDistance
+
+            # richest first, which a rescore may have undone
+            keep = np.flatnonzero(keep)
+            return routes.take(keep[np.argsort(-routes.revenues[keep], kind="stable")])
+
+    def __init__(self):
+        self.hexes = None
+        self.phase = None
+        self.entries = {}
+
+    # unlike RouteCache.signature, stations are left out
+    @staticmethod
+    def signature(hx):
+        return (hx.key, hx.rotation, str(hx.connections), str(hx.revenue))
+
+    def update(self, map):
+        hexes = { (r,c): RouteIndex.signature(hx) for r, c, hx in map.getHexes() }
+        if hexes != self.hexes or len(RouteCache.startedPaying(map, self.phase)) > 0:
+            self.entries = {}
+        elif map.getPhase() != self.phase:
+            for entry in self.entries.values():
+                entry.routes = entry.routes.rescored(map)
+        self.hexes = hexes
+        self.phase = map.getPhase()
+
+    # the entry holding the routes up to maxDistance, if there is one
+    def lookup(self, countsTowns, maxDistance):
+        entry = self.entries.get(countsTowns)
+        if entry != None and maxDistance <= entry.maxDistance:
+            return entry
+        return None
+
+    def store(self, map, countsTowns, maxDistance, routes):
+        self.entries[countsTowns] = RouteIndex.Entry(map, maxDistance, routes)
+        return self.entries[countsTowns]
+
+# process pool workers for MapSolver.findAllRoutes. each worker keeps
+# its own solver holding the graph it was initialized with.
+workerSolver = None
+
+def initRouteWorker(graph, startingCitiesSet, countsTowns):
+    global workerSolver
+    workerSolver = MapSolver(None)
+    workerSolver.trace = None
+    workerSolver.graph = graph
+    workerSolver.startingCitiesSet = startingCitiesSet
+    workerSolver.countsTowns = countsTowns
+
+def findAllRoutesFromCityWorker(maxDistance, canonical, city):
+    workerSolver.explorations = 0
+    if canonical:
+        footprint = set()
+        cuts = {}
+        routes = workerSolver.findCanonicalRoutesFromCity(maxDistance, city, footprint, cuts)
+    else:
+        footprint = None
+        cuts = None
+        routes = workerSolver.findAllRoutesFromCity(maxDistance, city)
+    return routes, footprint, cuts, workerSolver.explorations
+
+# process pool workers for MapSolver.parallelBranchAndBound. each
+# worker rebuilds the columns of the route table that the search reads
+# once, from shared memory; everything else stays in the parent, which
+# gets routes back as indices into its table.
+workerTrains = None
+workerTwin = False
+workerRoutesByTrain = None
+workerIncumbent = None
+workerMemo = None
+
+def initBranchWorker(shmName, shape, trains, routesByTrain, incumbent, memoSize, lpTrains, deadline):
+    global workerSolver, workerTrains, workerTwin, workerRoutesByTrain, workerIncumbent, workerMemo
+
+    shm = multiprocessing.shared_memory.SharedMemory(name=shmName)
+    table = np.ndarray(shape, dtype=np.uint64, buffer=shm.buf)
+    routeTable = RouteTable(table[:, 0].astype(np.int64), table[:, 1:].copy())
+    del table
+    shm.close()
+
+    workerTrains = trains[1:]
+    workerTwin = len(trains) > 1 and trains[1] == trains[0]
+    workerRoutesByTrain = dict([ (t, routesByTrain[t]) for t in set(workerTrains) ])
+
+    workerSolver = MapSolver(None)
+    workerSolver.trace = None
+    workerSolver.routeTable = routeTable
+    workerSolver.memoSize = memoSize
+    workerSolver.lpTrains = lpTrains
+    workerSolver.deadline = deadline
+    workerIncumbent = incumbent
+    workerMemo = collections.OrderedDict()
+
+def branchWorker(bestRemainingRevenues, branch):
+    ri, position, lpBound = branch
+    revenues = workerSolver.routeTable.revenueList()
+
+    # the top-level bound from trainLoop: no later (cheaper) branch
+    # can do better either, so these all return straight away once
+    # the incumbent is high enough
+    if revenues[ri] + bestRemainingRevenues < workerIncumbent.value:
+        return None
+
+    workerSolver.combinations = 1
+    workerSolver.memoHits = 0
+    workerSolver.memoMisses = 0
+    workerSolver.stats = MapSolver.Stats()
+
+    if lpBound <= workerIncumbent.value:
+        return (0, [], 1, 0, 0, { "lp": 1 }, True)
+
+    _, bestRoutes = workerSolver.branchAndBound(workerTrains, workerRoutesByTrain,
+                                                workerSolver.routeTable.maskInts()[ri], revenues[ri], [ri],
+                                                workerIncumbent, workerMemo, position if workerTwin else 0)
+
+    return (sum([ revenues[x] for x in bestRoutes ]), bestRoutes,
+            workerSolver.combinations, workerSolver.memoHits, workerSolver.memoMisses,
+            workerSolver.stats.prunes, workerSolver.provenOptimal)
+
+# process pool workers for MapSolver.adviseTiles. each worker keeps
+# its own copy of the map and route cache, which it reuses for every
+# hex it is given.
+workerAdvice = None
+
+def initTileWorker(map, company, engine, routeCache):
+    global workerAdvice
+    workerAdvice = (map, company, engine, routeCache)
+
+def tileWorker(loc):
+    map, company, engine, routeCache = workerAdvice
+    return MapSolver.scoreTiles(map, company, engine, routeCache, *loc)
+
+# process pool workers for MapSolver.adviseStations, which each keep
+# their own copy of the map and route index
+workerStations = None
+
+def initStationWorker(map, company, others, engine, routeIndex):
+    global workerStations
+    workerStations = (map, company, others, engine, routeIndex)
+
+def stationWorker(station):
+    return MapSolver.scoreStation(*workerStations, *station)
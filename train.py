@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+# how a train runs. distance is the number of stops it may count
+# (None for no limit), countsTowns says whether towns are stops at all
+# or just track it runs through, and maxCities caps how many of its
+# stops may be cities (or off-boards).
+#
+# trains that agree on countsTowns run over the same graph, so the
+# solver finds their routes together and each train picks out the ones
+# it can run.
+class Train:
+    def __init__(self, name, distance, countsTowns=True, maxCities=None):
+        self.name = name
+        self.distance = distance
+        self.countsTowns = countsTowns
+        self.maxCities = maxCities
+
+    def __repr__(self):
+        return "(Train: %s)" % (self.name)
+
+    # trains are named as in the map files and Company.trains: a number
+    # is a plain n-train, and the letters are the special trains.
+    #
+    # an L-train runs two stops, at most one of them a city. an E-train
+    # runs any distance, and counts only cities and off-boards.
+    @staticmethod
+    def get(name):
+        if name == "L":
+            return Train(name, 2, maxCities=1)
+        elif name == "E":
+            return Train(name, None, countsTowns=False)
+        else:
+            return Train(name, int(name))
+
+    # sorts trains from the least to the most they can run
+    def size(self):
+        return (self.distance if self.distance != None else float('inf'),
+                self.maxCities if self.maxCities != None else float('inf'))
+
+    # which of the routes in a solver.RouteTable (found over this
+    # train's graph) the train can run, as a boolean array
+    def runnable(self, routes):
+        ok = np.ones(len(routes), dtype=bool)
+        if self.distance != None:
+            ok &= routes.distances <= self.distance
+        if self.maxCities != None:
+            ok &= routes.cities() <= self.maxCities
+        return ok